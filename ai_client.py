@@ -1,10 +1,18 @@
 import asyncio
-import json
+import functools
 import logging
+import random
+import re
 import time
-from collections.abc import AsyncGenerator
+from collections import deque
+from collections.abc import AsyncGenerator, Iterator
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 import aiohttp
+import ijson
+import orjson
+from multidict import CIMultiDict, CIMultiDictProxy
 
 from api_manager import ApiKeyManager, KeyState
 from config import Config
@@ -13,15 +21,145 @@ logger = logging.getLogger(__name__)
 
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent"
+GEMINI_HEADERS = CIMultiDictProxy(CIMultiDict({"Content-Type": "application/json"}))
+
+# Лёгкие адреса для прогрева DNS и TLS при старте
+_WARMUP_URLS = {
+    "openrouter": "https://openrouter.ai/api/v1/models",
+    "gemini": "https://generativelanguage.googleapis.com/",
+}
+_WARMUP_TIMEOUT = 5.0
+
+# Экспоненциальный backoff для ретраев (секунды)
+_BACKOFF_BASE = 1.0
+_BACKOFF_CAP = 30.0
+
+# Retry-After не длиннее этого (секунды) пережидаем на том же ключе
+_SHORT_RETRY_AFTER = 10.0
+
+# Сколько байт тела ошибки читаем для логов и классификации
+_ERROR_BODY_LIMIT = 2048
+
+# Размер порции чтения SSE-потока: ограничивает работу сплиттера за одну итерацию
+_SSE_READ_CHUNK = 4096
+
+
+async def _read_error_body(resp: aiohttp.ClientResponse) -> str:
+    """Читает только начало тела ошибки: дальше первых килобайт оно нигде не используется."""
+    # read(n) отдаёт то, что уже в буфере, и может вернуть лишь начало сообщения
+    try:
+        raw = await resp.content.readexactly(_ERROR_BODY_LIMIT)
+    except asyncio.IncompleteReadError as e:
+        raw = e.partial
+    return raw.decode("utf-8", errors="ignore")
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """Разбирает Retry-After: число секунд или HTTP-дата."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+async def _backoff(attempt: int) -> None:
+    """Пауза перед повтором: экспонента с full jitter, чтобы ретраи не синхронизировались."""
+    await asyncio.sleep(random.uniform(0, min(_BACKOFF_CAP, _BACKOFF_BASE * (2 ** attempt))))
+
+
+async def _iter_sse_lines(
+    content: aiohttp.StreamReader,
+    stall_timeout: float | None = None,
+) -> AsyncGenerator[bytes, None]:
+    """Режет поток на строки по b"\\n" за линейное время.
+
+    В отличие от StreamReader.readline, не ограничивает длину строки
+    (тот падает с "Chunk too big" на кадрах больше ~128 КБ). Если тело молчит
+    дольше stall_timeout, бросает ServerTimeoutError, как sock_read в aiohttp.
+    """
+    buffer = bytearray()
+    while True:
+        stall = asyncio.timeout(stall_timeout)
+        try:
+            async with stall:
+                raw_chunk = await content.read(_SSE_READ_CHUNK)
+        except TimeoutError:
+            # Истёк не наш сторож, а total запроса — пусть летит как есть
+            if not stall.expired():
+                raise
+            raise aiohttp.ServerTimeoutError(
+                f"No stream data for {stall_timeout} seconds"
+            ) from None
+        if not raw_chunk:
+            break
+        # В старом хвосте перевода строки нет — ищем только в новых байтах
+        search_from = len(buffer)
+        buffer.extend(raw_chunk)
+        start = 0
+        while (nl := buffer.find(b"\n", search_from)) != -1:
+            yield bytes(buffer[start:nl])
+            start = search_from = nl + 1
+        if start:
+            del buffer[:start]
+    if buffer:
+        yield bytes(buffer)
+
+
+async def _coalesce(
+    gen: AsyncGenerator[str, None],
+    min_chars: int,
+    max_delay: float,
+) -> AsyncGenerator[str, None]:
+    """Склеивает мелкие дельты: отдаёт накопленное, когда набралось min_chars или прошло max_delay."""
+    parts: list[str] = []
+    size = 0
+    last_flush = time.monotonic()
+    try:
+        async for piece in gen:
+            parts.append(piece)
+            size += len(piece)
+            now = time.monotonic()
+            if size >= min_chars or now - last_flush >= max_delay:
+                yield "".join(parts)
+                parts.clear()
+                size = 0
+                last_flush = now
+        if parts:
+            yield "".join(parts)
+    finally:
+        await gen.aclose()
+
+
+@functools.lru_cache(maxsize=64)
+def _gemini_url(model: str) -> str:
+    return GEMINI_URL.format(model=model)
+
+
+def _json_dumps(obj: object) -> str:
+    return orjson.dumps(obj).decode()
 
 
 class AiError(Exception):
+    __slots__ = ("recoverable",)
+
     def __init__(self, message: str, recoverable: bool = True) -> None:
         super().__init__(message)
         self.recoverable = recoverable
 
 
 class AllKeysExhaustedError(AiError):
+    __slots__ = ("recovery_time",)
+
     def __init__(self, recovery_time: str | None = None) -> None:
         self.recovery_time = recovery_time
         msg = "Все API-ключи временно исчерпаны."
@@ -31,75 +169,231 @@ class AllKeysExhaustedError(AiError):
 
 
 class KeyExhaustedException(Exception):
-    pass
+    __slots__ = ("retry_after",)
+
+    def __init__(self, retry_after: float | None = None) -> None:
+        super().__init__()
+        self.retry_after = retry_after
 
 
 class KeyAuthError(Exception):
-    pass
+    __slots__ = ()
 
 
 class ServerError(Exception):
-    pass
-
-
-def _is_rate_limit_error(error_obj: dict | str) -> bool:
-    """Проверяет является ли ошибка rate limit / quota exceeded."""
-    if isinstance(error_obj, dict):
-        text = json.dumps(error_obj).lower()
-    else:
-        text = str(error_obj).lower()
-
-    rate_phrases = [
-        "rate_limit_exceeded",
-        "rate limit",
-        "quota exceeded",
-        "resource_exhausted",
-        "resource has been exhausted",
-        "too many requests",
-        "limit reached",
-        "insufficient_quota",
-        "exceeded your current quota",
-        "requests per minute",
-        "tokens per minute",
-    ]
-    return any(phrase in text for phrase in rate_phrases)
-
-
-def _is_auth_error(error_obj: dict | str) -> bool:
-    """Проверяет является ли ошибка авторизационной."""
-    if isinstance(error_obj, dict):
-        text = json.dumps(error_obj).lower()
-    else:
-        text = str(error_obj).lower()
-
-    auth_phrases = [
-        "invalid api key",
-        "invalid_api_key",
-        "api key not valid",
-        "api_key_invalid",
-        "permission denied",
-        "authentication failed",
-    ]
-    return any(phrase in text for phrase in auth_phrases)
+    __slots__ = ()
+
+
+_RATE_LIMIT_PHRASES = (
+    "rate_limit_exceeded",
+    "rate limit",
+    "quota exceeded",
+    "resource_exhausted",
+    "resource has been exhausted",
+    "too many requests",
+    "limit reached",
+    "insufficient_quota",
+    "exceeded your current quota",
+    "requests per minute",
+    "tokens per minute",
+)
+
+_AUTH_PHRASES = (
+    "invalid api key",
+    "invalid_api_key",
+    "api key not valid",
+    "api_key_invalid",
+    "permission denied",
+    "authentication failed",
+)
+
+# Один проход по тексту вместо отдельного поиска каждой фразы
+_RATE_LIMIT_RE = re.compile("|".join(map(re.escape, _RATE_LIMIT_PHRASES)), re.IGNORECASE)
+_AUTH_RE = re.compile("|".join(map(re.escape, _AUTH_PHRASES)), re.IGNORECASE)
+
+
+# Ключ ищем вместе с префиксом delta: "content" бывает и в message, и в ошибках
+_DELTA_CONTENT_KEY = b'"delta":{"content":"'
+_CONTENT_KEY = b'"content":"'
+
+
+def _fast_delta_content(data_bytes: bytes) -> str | None:
+    """Достаёт delta.content из типового кадра OpenRouter без построения dict.
+
+    Возвращает None, если кадр не похож на простую дельту (content не первым
+    полем delta, ошибка, несколько полей content, экранированные символы) —
+    тогда нужен полный разбор JSON.
+    """
+    if b'"error"' in data_bytes:
+        return None
+    start = data_bytes.find(_DELTA_CONTENT_KEY)
+    if start == -1:
+        return None
+    # Другой "content" раньше дельты — формат не типовой
+    if data_bytes.find(_CONTENT_KEY, 0, start) != -1:
+        return None
+    start += len(_DELTA_CONTENT_KEY)
+    end = data_bytes.find(b'"', start)
+    if end == -1:
+        return None
+    value = data_bytes[start:end]
+    # С экранированием (\n, \", \uXXXX) честнее отдать строку orjson
+    if b"\\" in value or data_bytes.find(_CONTENT_KEY, end) != -1:
+        return None
+    return value.decode("utf-8")
+
+
+def _text_leaves(obj: object) -> Iterator[str]:
+    """Обходит вложенные dict/list и отдаёт только строковые значения."""
+    if isinstance(obj, str):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from _text_leaves(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            yield from _text_leaves(value)
+
+
+def _error_text(error_obj: dict | str) -> str:
+    """Собирает текст ошибки для поиска фраз без сериализации в JSON."""
+    if isinstance(error_obj, str):
+        return error_obj
+    return "\n".join(_text_leaves(error_obj))
 
 
 def _classify_error(error_obj: dict | str) -> None:
     """Бросает нужное исключение если ошибка распознана."""
-    if _is_rate_limit_error(error_obj):
+    text = _error_text(error_obj)
+    if _RATE_LIMIT_RE.search(text):
         raise KeyExhaustedException()
-    if _is_auth_error(error_obj):
+    if _AUTH_RE.search(text):
         raise KeyAuthError()
 
 
+class _Breaker:
+    """Circuit breaker провайдера: closed -> open -> half-open -> closed.
+
+    Размыкается после N неудач подряд или когда доля неудач в последних запросах
+    слишком высока. По истечении паузы пропускает один пробный запрос: успех
+    замыкает цепь, неудача снова размыкает её на break_duration.
+    Неудачей считаются 5xx, таймауты и обрывы соединения; 429 на ключе — нет.
+    """
+
+    def __init__(
+        self,
+        window: int = 20,
+        failure_ratio: float = 0.5,
+        min_throughput: int = 10,
+        consecutive_failures: int = 5,
+        break_duration: float = 30.0,
+    ) -> None:
+        self._outcomes: deque[bool] = deque(maxlen=window)
+        self._failure_ratio = failure_ratio
+        self._min_throughput = min_throughput
+        self._consecutive_limit = consecutive_failures
+        self._consecutive = 0
+        self._break_duration = break_duration
+        self.open_until = 0.0
+        self._half_open = False
+        # Пока пробный запрос в полёте, остальных не пускаем; если он так и не
+        # отчитался (таймаут, отмена), через break_duration пускаем новый
+        self._probe_until = 0.0
+
+    def is_open(self) -> bool:
+        now = time.monotonic()
+        if self.open_until and now >= self.open_until:
+            self.open_until = 0.0
+            self._half_open = True
+        if self._half_open:
+            if now < self._probe_until:
+                return True
+            self._probe_until = now + self._break_duration
+            return False
+        return self.open_until > 0.0
+
+    def record_success(self) -> None:
+        if self._half_open:
+            self._half_open = False
+            self._probe_until = 0.0
+            self._outcomes.clear()
+        self._consecutive = 0
+        self._outcomes.append(True)
+
+    def release_probe(self) -> None:
+        """Нейтральный исход (ротация ключа по 429): цепь не меняем, но пробу отпускаем."""
+        self._probe_until = 0.0
+
+    def record_failure(self) -> None:
+        if self._half_open:
+            self._trip()
+            return
+        self._outcomes.append(False)
+        self._consecutive += 1
+        if self._consecutive >= self._consecutive_limit:
+            self._trip()
+            return
+        total = len(self._outcomes)
+        if total < self._min_throughput:
+            return
+        failures = total - sum(self._outcomes)
+        if failures / total >= self._failure_ratio:
+            self._trip()
+
+    def _trip(self) -> None:
+        self.open_until = time.monotonic() + self._break_duration
+        self._half_open = False
+        self._probe_until = 0.0
+        self._consecutive = 0
+        self._outcomes.clear()
+
+
 class AiClient:
     def __init__(self, config: Config, key_manager: ApiKeyManager) -> None:
         self._config = config
         self._key_manager = key_manager
         self._session: aiohttp.ClientSession | None = None
+        self._breakers: dict[str, _Breaker] = {
+            "openrouter": _Breaker(),
+            "gemini": _Breaker(),
+        }
+        # Ограничиваем число одновременных стримов, чтобы не упереться в пул и лимит FD
+        self._gate = asyncio.Semaphore(config.api.max_concurrent_streams)
 
     async def start(self) -> None:
+        # Ожидание заголовков (модель может долго думать до первого байта) ограничено
+        # только total. Сторож зависшего тела — stream_stall_timeout в _iter_sse_lines:
+        # sock_read aiohttp накрыл бы и ожидание заголовков
         timeout = aiohttp.ClientTimeout(total=self._config.api.request_timeout)
-        self._session = aiohttp.ClientSession(timeout=timeout)
+        # Пул keep-alive соединений: стримы и ретраи переиспользуют прогретый TLS
+        connector = aiohttp.TCPConnector(
+            limit=self._config.api.pool_limit,
+            limit_per_host=64,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,
+        )
+        self._session = aiohttp.ClientSession(
+            timeout=timeout,
+            connector=connector,
+            json_serialize=_json_dumps,
+        )
+        # Первый запрос пользователя не должен платить за DNS и TLS handshake
+        await asyncio.gather(*(
+            self._warmup(_WARMUP_URLS[p])
+            for p in self._key_manager.get_providers_with_keys()
+        ))
+
+    async def _warmup(self, url: str) -> None:
+        try:
+            async with self.session.head(
+                url,
+                allow_redirects=False,
+                timeout=aiohttp.ClientTimeout(total=_WARMUP_TIMEOUT),
+            ):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Warmup of %s failed: %s", url, e)
 
     async def close(self) -> None:
         if self._session:
@@ -118,52 +412,168 @@ class AiClient:
         model: str,
         provider: str,
     ) -> AsyncGenerator[str, None]:
-        max_key_attempts = 5
-        for attempt in range(max_key_attempts):
-            key = await self._key_manager.get_key(provider)
-            if key is None:
-                recovery = await self._key_manager.get_recovery_time(provider)
-                raise AllKeysExhaustedError(recovery)
-
-            try:
-                if provider == "openrouter":
-                    gen = self._stream_openrouter(messages, model, key)
-                else:
-                    gen = self._stream_gemini(messages, model, key)
+        async with self._gate:
+            breaker = self._breakers[provider]
+            max_key_attempts = 5
+            for attempt in range(max_key_attempts):
+                if breaker.is_open():
+                    logger.warning("Circuit for %s is open, failing fast", provider)
+                    recovery = await self._key_manager.get_recovery_time(provider)
+                    raise AllKeysExhaustedError(recovery)
+
+                key = await self._key_manager.get_key(provider)
+                if key is None:
+                    recovery = await self._key_manager.get_recovery_time(provider)
+                    raise AllKeysExhaustedError(recovery)
 
                 collected = False
-                async for chunk in gen:
-                    collected = True
-                    yield chunk
+                try:
+                    first: str | None = None
+                    if self._config.api.hedged_requests and attempt > 0:
+                        key, gen, first, error = await self._race_first_chunk(
+                            messages, model, provider, key
+                        )
+                        if error is not None:
+                            raise error
+                    else:
+                        gen = self._open_stream(messages, model, provider, key)
+
+                    if first is not None:
+                        collected = True
+                        yield first
+                    async for chunk in gen:
+                        collected = True
+                        yield chunk
+
+                    breaker.record_success()
+                    if collected:
+                        self._key_manager.record_usage(key.key_hash)
+                    return
 
-                if collected:
-                    await self._key_manager.record_usage(key.key_hash)
-                return
+                except KeyExhaustedException as e:
+                    # 429 говорит о лимите ключа, а не о здоровье провайдера
+                    breaker.release_probe()
+                    await self._key_manager.mark_exhausted(
+                        key.key_hash, provider, e.retry_after
+                    )
+                    logger.warning(
+                        "Key %s exhausted (attempt %d/%d), rotating...",
+                        key.key_hash, attempt + 1, max_key_attempts,
+                    )
+                    continue
 
-            except KeyExhaustedException:
-                await self._key_manager.mark_exhausted(key.key_hash, provider)
-                logger.warning(
-                    "Key %s exhausted (attempt %d/%d), rotating...",
-                    key.key_hash, attempt + 1, max_key_attempts,
-                )
-                continue
+                except KeyAuthError:
+                    # Провайдер ответил — для цепи это успех, виноват только ключ
+                    breaker.record_success()
+                    await self._key_manager.mark_error(key.key_hash, provider)
+                    logger.error("Key %s auth error, disabling", key.key_hash)
+                    continue
 
-            except KeyAuthError:
-                await self._key_manager.mark_error(key.key_hash, provider)
-                logger.error("Key %s auth error, disabling", key.key_hash)
-                continue
+                except ServerError as e:
+                    breaker.record_failure()
+                    if collected:
+                        # Часть ответа уже у пользователя — другой ключ начал бы его заново
+                        logger.warning("Stream broke mid-answer: %s", e)
+                        raise AiError("⚠️ Ответ прервался. Попробуйте ещё раз.")
+                    logger.warning("Server error: %s, retrying...", e)
+                    await _backoff(attempt)
+                    continue
 
-            except ServerError as e:
-                logger.warning("Server error: %s, retrying...", e)
-                await asyncio.sleep(5)
-                continue
+                except asyncio.TimeoutError:
+                    breaker.record_failure()
+                    logger.warning("Request timeout for key %s", key.key_hash)
+                    raise AiError("⏱ Превышено время ожидания ответа от AI. Попробуйте ещё раз.")
 
-            except asyncio.TimeoutError:
-                logger.warning("Request timeout for key %s", key.key_hash)
-                raise AiError("⏱ Превышено время ожидания ответа от AI. Попробуйте ещё раз.")
+            recovery = await self._key_manager.get_recovery_time(provider)
+            raise AllKeysExhaustedError(recovery)
 
-        recovery = await self._key_manager.get_recovery_time(provider)
-        raise AllKeysExhaustedError(recovery)
+    def _open_stream(
+        self,
+        messages: list[dict[str, str]],
+        model: str,
+        provider: str,
+        key: KeyState,
+    ) -> AsyncGenerator[str, None]:
+        if provider == "openrouter":
+            gen = self._stream_openrouter(messages, model, key)
+        else:
+            gen = self._stream_gemini(messages, model, key)
+        api = self._config.api
+        return _coalesce(gen, api.stream_coalesce_chars, api.stream_coalesce_ms / 1000)
+
+    async def _race_first_chunk(
+        self,
+        messages: list[dict[str, str]],
+        model: str,
+        provider: str,
+        key: KeyState,
+    ) -> tuple[KeyState, AsyncGenerator[str, None], str | None, BaseException | None]:
+        """Hedged-запрос: ждём первый чанк сразу от двух ключей и стримим из того, кто ответил первым.
+
+        Возвращает (ключ, генератор, первый чанк, ошибка). Ошибка последнего
+        оставшегося ключа возвращается вызывающему, чтобы тот обработал её как обычно.
+        """
+        backup = await self._key_manager.get_key(provider)
+        if backup is None or backup.key_hash == key.key_hash:
+            return key, self._open_stream(messages, model, provider, key), None, None
+
+        tasks: dict[asyncio.Task, tuple[KeyState, AsyncGenerator[str, None]]] = {}
+        opened: list[AsyncGenerator[str, None]] = []
+        winner: AsyncGenerator[str, None] | None = None
+        for ks in (key, backup):
+            gen = self._open_stream(messages, model, provider, ks)
+            opened.append(gen)
+            tasks[asyncio.ensure_future(gen.__anext__())] = (ks, gen)
+
+        try:
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    ks, gen = tasks.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        chunk = task.result()
+                        if chunk:
+                            winner = gen
+                            return ks, gen, chunk, None
+                        # Пустой кадр ещё не ответ — ждём от этого ключа следующий
+                        tasks[asyncio.ensure_future(gen.__anext__())] = (ks, gen)
+                        continue
+                    if isinstance(error, StopAsyncIteration):
+                        if not tasks:
+                            winner = gen
+                            return ks, gen, None, None
+                        continue
+                    if not tasks:
+                        winner = gen
+                        return ks, gen, None, error
+                    await self._discard_hedged_key(error, ks, provider)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Проигравший мог тоже успеть отдать чанк в этом же раунде — закрываем
+            # его явно, чтобы ответ и соединение вернулись в пул сразу, а не при GC
+            for gen in opened:
+                if gen is not winner:
+                    await gen.aclose()
+
+    async def _discard_hedged_key(
+        self, error: BaseException, key: KeyState, provider: str
+    ) -> None:
+        logger.warning(
+            "Hedged request on key %s failed: %s", key.key_hash, type(error).__name__
+        )
+        if isinstance(error, KeyExhaustedException):
+            self._breakers[provider].release_probe()
+            await self._key_manager.mark_exhausted(
+                key.key_hash, provider, error.retry_after
+            )
+        elif isinstance(error, KeyAuthError):
+            self._breakers[provider].record_success()
+            await self._key_manager.mark_error(key.key_hash, provider)
+        elif isinstance(error, (ServerError, asyncio.TimeoutError)):
+            self._breakers[provider].record_failure()
 
     async def _stream_openrouter(
         self,
@@ -171,50 +581,62 @@ class AiClient:
         model: str,
         key: KeyState,
     ) -> AsyncGenerator[str, None]:
-        headers = {
-            "Authorization": f"Bearer {key.raw_key}",
-            "HTTP-Referer": "https://github.com/ai-telegram-bot",
-            "Content-Type": "application/json",
-        }
-        payload = {
+        headers = key.openrouter_headers
+        # Сериализуем один раз сразу в bytes — ретраи отправляют тот же буфер
+        body_bytes = orjson.dumps({
             "model": model,
             "messages": messages,
             "stream": True,
             "max_tokens": 4096,
-        }
+        })
 
         max_retries = 3
+        # После первого отданного куска запрос не повторяем: текст бы задвоился
+        yielded = False
         for retry in range(max_retries):
             try:
                 async with self.session.post(
-                    OPENROUTER_URL, json=payload, headers=headers
+                    OPENROUTER_URL, data=body_bytes, headers=headers
                 ) as resp:
-                    logger.debug(
-                        "OpenRouter response: status=%d, content-type=%s, key=%s",
-                        resp.status, resp.headers.get("content-type", ""), key.key_hash,
-                    )
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(
+                            "OpenRouter response: status=%d, content-type=%s, key=%s",
+                            resp.status, resp.headers.get("content-type", ""), key.key_hash,
+                        )
 
                     if resp.status == 429:
-                        body = await resp.text()
-                        logger.warning("OpenRouter 429: %s", body[:500])
-                        raise KeyExhaustedException()
+                        body = await _read_error_body(resp)
+                        logger.warning("OpenRouter 429: %.500s", body)
+                        retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+                        if (
+                            retry_after is not None
+                            and retry_after <= _SHORT_RETRY_AFTER
+                            and retry < max_retries - 1
+                        ):
+                            # Короткий лимит — ждём на том же ключе, не сжигая его на весь cooldown.
+                            # Соединение отдаём в пул до сна, а не держим его всю паузу
+                            resp.release()
+                            await asyncio.sleep(retry_after)
+                            continue
+                        raise KeyExhaustedException(retry_after)
 
                     if resp.status in (401, 403):
-                        body = await resp.text()
-                        logger.warning("OpenRouter %d: %s", resp.status, body[:500])
+                        body = await _read_error_body(resp)
+                        logger.warning("OpenRouter %d: %.500s", resp.status, body)
                         raise KeyAuthError()
 
                     if resp.status >= 500:
-                        body = await resp.text()
-                        logger.warning("OpenRouter %d: %s", resp.status, body[:500])
+                        body = await _read_error_body(resp)
+                        logger.warning("OpenRouter %d: %.500s", resp.status, body)
                         if retry < max_retries - 1:
-                            await asyncio.sleep(5)
+                            resp.release()
+                            await _backoff(retry)
                             continue
                         raise ServerError(f"Server returned {resp.status}")
 
                     if resp.status != 200:
-                        body = await resp.text()
-                        logger.warning("OpenRouter %d: %s", resp.status, body[:500])
+                        body = await _read_error_body(resp)
+                        logger.warning("OpenRouter %d: %.500s", resp.status, body)
                         _classify_error(body)
                         raise AiError(f"API error {resp.status}: {body[:200]}")
 
@@ -222,89 +644,40 @@ class AiClient:
                     content_type = resp.headers.get("content-type", "")
 
                     if "text/event-stream" not in content_type and "stream" not in content_type:
-                        # Не-stream ответ — читаем целиком
-                        body = await resp.text()
-                        logger.debug("OpenRouter non-stream body: %s", body[:1000])
-
-                        try:
-                            data = json.loads(body)
-
-                            # Проверяем ошибку в JSON
-                            if "error" in data:
-                                error_obj = data["error"]
-                                logger.warning("OpenRouter error in body: %s", error_obj)
-                                _classify_error(error_obj)
-                                error_msg = error_obj.get("message", str(error_obj)) if isinstance(error_obj, dict) else str(error_obj)
-                                raise AiError(f"API error: {error_msg[:200]}")
-
-                            # Извлекаем контент из обычного ответа
-                            choices = data.get("choices", [])
-                            if choices:
-                                content = choices[0].get("message", {}).get("content", "")
-                                if content:
-                                    yield content
-                                    return
-                        except json.JSONDecodeError:
-                            logger.warning("OpenRouter non-JSON body: %s", body[:500])
+                        # Не-stream ответ — разбираем инкрементально, не держа всё тело в памяти
+                        async for content in self._iter_json_content(resp):
+                            yielded = True
+                            yield content
                         return
 
                     # SSE stream
-                    buffer = ""
-                    async for raw_chunk in resp.content.iter_any():
-                        buffer += raw_chunk.decode("utf-8", errors="ignore")
-
-                        while "\n" in buffer:
-                            line, buffer = buffer.split("\n", 1)
-                            line = line.strip()
-                            if not line:
-                                continue
-
-                            # Извлекаем data из SSE
-                            if line.startswith("data: "):
-                                data_str = line[6:]
-                            elif line.startswith("data:"):
-                                data_str = line[5:]
-                            elif line.startswith(":"):
-                                continue
-                            else:
-                                continue
-
-                            data_str = data_str.strip()
-                            if data_str == "[DONE]":
-                                return
-                            if not data_str:
-                                continue
-
+                    async for data_bytes in self._sse_data(
+                        resp, b'"content"', self._config.api.stream_stall_timeout
+                    ):
+                        content = _fast_delta_content(data_bytes)
+                        if content is None:
+                            data = self._parse_sse_frame(data_bytes, "OpenRouter")
                             try:
-                                data = json.loads(data_str)
-
-                                # Ошибка внутри SSE
-                                if "error" in data:
-                                    error_obj = data["error"]
-                                    logger.warning("OpenRouter stream error: %s", error_obj)
-                                    _classify_error(error_obj)
-                                    error_msg = error_obj.get("message", str(error_obj)) if isinstance(error_obj, dict) else str(error_obj)
-                                    raise AiError(f"Stream error: {error_msg[:200]}")
-
-                                choices = data.get("choices", [])
-                                if not choices:
-                                    continue
-
-                                delta = choices[0].get("delta", {})
-                                content = delta.get("content", "")
-                                if content:
-                                    yield content
-
-                            except json.JSONDecodeError:
+                                content = data["choices"][0]["delta"]["content"]
+                            except (KeyError, IndexError, TypeError):
                                 continue
+                        if content:
+                            yielded = True
+                            yield content
                     return
 
             except (KeyExhaustedException, KeyAuthError, AiError):
                 raise
             except aiohttp.ClientError as e:
                 logger.warning("OpenRouter connection error: %s", e)
+                if yielded:
+                    # Часть текста уже отдана — повтор запроса продублировал бы её.
+                    # Зависший стрим отдаём наверх как обычный таймаут
+                    if isinstance(e, aiohttp.ServerTimeoutError):
+                        raise asyncio.TimeoutError(str(e)) from e
+                    raise ServerError(str(e))
                 if retry < max_retries - 1:
-                    await asyncio.sleep(5)
+                    await _backoff(retry)
                     continue
                 raise ServerError(str(e))
 
@@ -314,154 +687,243 @@ class AiClient:
         model: str,
         key: KeyState,
     ) -> AsyncGenerator[str, None]:
-        url = GEMINI_URL.format(model=model)
-        params = {"key": key.raw_key, "alt": "sse"}
+        url = _gemini_url(model)
+        params = key.gemini_params
 
         contents = self._convert_messages_to_gemini(messages)
-        payload = {
+        body_bytes = orjson.dumps({
             "contents": contents,
             "generationConfig": {
                 "maxOutputTokens": 4096,
                 "temperature": 0.7,
             },
-        }
+        })
 
         max_retries = 3
+        # После первого отданного куска запрос не повторяем: текст бы задвоился
+        yielded = False
         for retry in range(max_retries):
             try:
                 async with self.session.post(
-                    url, json=payload, params=params
+                    url, data=body_bytes, params=params, headers=GEMINI_HEADERS
                 ) as resp:
-                    logger.debug(
-                        "Gemini response: status=%d, content-type=%s, key=%s",
-                        resp.status, resp.headers.get("content-type", ""), key.key_hash,
-                    )
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(
+                            "Gemini response: status=%d, content-type=%s, key=%s",
+                            resp.status, resp.headers.get("content-type", ""), key.key_hash,
+                        )
 
                     if resp.status == 429:
-                        body = await resp.text()
-                        logger.warning("Gemini 429: %s", body[:500])
-                        raise KeyExhaustedException()
+                        body = await _read_error_body(resp)
+                        logger.warning("Gemini 429: %.500s", body)
+                        retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+                        if (
+                            retry_after is not None
+                            and retry_after <= _SHORT_RETRY_AFTER
+                            and retry < max_retries - 1
+                        ):
+                            # Короткий лимит — ждём на том же ключе, не сжигая его на весь cooldown.
+                            # Соединение отдаём в пул до сна, а не держим его всю паузу
+                            resp.release()
+                            await asyncio.sleep(retry_after)
+                            continue
+                        raise KeyExhaustedException(retry_after)
 
                     if resp.status in (401, 403):
-                        body = await resp.text()
-                        logger.warning("Gemini %d: %s", resp.status, body[:500])
+                        body = await _read_error_body(resp)
+                        logger.warning("Gemini %d: %.500s", resp.status, body)
                         raise KeyAuthError()
 
                     if resp.status >= 500:
-                        body = await resp.text()
-                        logger.warning("Gemini %d: %s", resp.status, body[:500])
+                        body = await _read_error_body(resp)
+                        logger.warning("Gemini %d: %.500s", resp.status, body)
                         if retry < max_retries - 1:
-                            await asyncio.sleep(5)
+                            resp.release()
+                            await _backoff(retry)
                             continue
                         raise ServerError(f"Gemini server returned {resp.status}")
 
                     if resp.status != 200:
-                        body = await resp.text()
-                        logger.warning("Gemini %d: %s", resp.status, body[:500])
+                        body = await _read_error_body(resp)
+                        logger.warning("Gemini %d: %.500s", resp.status, body)
 
                         # Парсим JSON-ошибку
                         try:
-                            data = json.loads(body)
+                            data = orjson.loads(body)
                             if "error" in data:
                                 error_obj = data["error"]
                                 logger.warning("Gemini error: %s", error_obj)
                                 _classify_error(error_obj)
                                 error_msg = error_obj.get("message", str(error_obj)) if isinstance(error_obj, dict) else str(error_obj)
                                 raise AiError(f"Gemini error: {error_msg[:200]}")
-                        except json.JSONDecodeError:
+                        except orjson.JSONDecodeError:
                             pass
 
                         _classify_error(body)
                         raise AiError(f"Gemini API error {resp.status}: {body[:200]}")
 
                     # SSE stream
-                    buffer = ""
-                    async for raw_chunk in resp.content.iter_any():
-                        buffer += raw_chunk.decode("utf-8", errors="ignore")
-
-                        while "\n" in buffer:
-                            line, buffer = buffer.split("\n", 1)
-                            line = line.strip()
-                            if not line:
-                                continue
-
-                            # Убираем SSE-префикс
-                            if line.startswith("data: "):
-                                line = line[6:]
-                            elif line.startswith("data:"):
-                                line = line[5:]
-                            elif line.startswith(":"):
-                                continue
-
-                            line = line.strip()
-                            if not line:
-                                continue
-
-                            try:
-                                data = json.loads(line)
-
-                                # Проверяем ошибку
-                                if "error" in data:
-                                    error_obj = data["error"]
-                                    logger.warning("Gemini stream error: %s", error_obj)
-                                    _classify_error(error_obj)
-                                    error_msg = error_obj.get("message", str(error_obj)) if isinstance(error_obj, dict) else str(error_obj)
-                                    raise AiError(f"Gemini error: {error_msg[:200]}")
-
-                                candidates = data.get("candidates", [])
-                                if not candidates:
-                                    continue
-
-                                parts = (
-                                    candidates[0]
-                                    .get("content", {})
-                                    .get("parts", [])
-                                )
-                                for part in parts:
-                                    text = part.get("text", "")
-                                    if text:
-                                        yield text
-
-                            except json.JSONDecodeError:
-                                continue
+                    async for data in self._sse_events(
+                        resp, "Gemini", b'"text"', self._config.api.stream_stall_timeout
+                    ):
+                        try:
+                            parts = data["candidates"][0]["content"]["parts"]
+                        except (KeyError, IndexError, TypeError):
+                            continue
+                        for part in parts:
+                            text = part.get("text")
+                            if text:
+                                yielded = True
+                                yield text
                     return
 
             except (KeyExhaustedException, KeyAuthError, AiError):
                 raise
             except aiohttp.ClientError as e:
                 logger.warning("Gemini connection error: %s", e)
+                if yielded:
+                    # Часть текста уже отдана — повтор запроса продублировал бы её.
+                    # Зависший стрим отдаём наверх как обычный таймаут
+                    if isinstance(e, aiohttp.ServerTimeoutError):
+                        raise asyncio.TimeoutError(str(e)) from e
+                    raise ServerError(str(e))
                 if retry < max_retries - 1:
-                    await asyncio.sleep(5)
+                    await _backoff(retry)
                     continue
                 raise ServerError(str(e))
 
+    @staticmethod
+    async def _iter_json_content(
+        resp: aiohttp.ClientResponse,
+    ) -> AsyncGenerator[str, None]:
+        """Достаёт `choices[].message.content` из обычного JSON-ответа по мере прихода байтов."""
+        error_builder: ijson.ObjectBuilder | None = None
+        try:
+            async for prefix, event, value in ijson.parse_async(resp.content):
+                if prefix == "choices.item.message.content" and event == "string":
+                    if value:
+                        yield value
+                        return
+                    continue
+
+                # Объект ошибки собираем целиком — он маленький
+                if prefix == "error" or prefix.startswith("error."):
+                    if error_builder is None:
+                        error_builder = ijson.ObjectBuilder()
+                    error_builder.event(event, value)
+                    if prefix == "error" and event not in ("start_map", "start_array", "map_key"):
+                        error_obj = error_builder.value
+                        logger.warning("OpenRouter error in body: %s", error_obj)
+                        _classify_error(error_obj)
+                        error_msg = error_obj.get("message", str(error_obj)) if isinstance(error_obj, dict) else str(error_obj)
+                        raise AiError(f"API error: {error_msg[:200]}")
+        except ijson.JSONError as e:
+            logger.warning("OpenRouter non-JSON body: %s", e)
+
+    @staticmethod
+    async def _sse_data(
+        resp: aiohttp.ClientResponse,
+        required_marker: bytes | None = None,
+        stall_timeout: float | None = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """Отдаёт полезную нагрузку строк `data:` до `[DONE]`.
+
+        Если задан required_marker, кадры без него (и без ошибки) отбрасываются
+        ещё до разбора JSON.
+        """
+        async for raw_line in _iter_sse_lines(resp.content, stall_timeout):
+            line = raw_line.strip()
+
+            # Пустые строки, комментарии ":" и прочие поля SSE пропускаем
+            if not line.startswith(b"data:"):
+                continue
+
+            data_bytes = line[5:].lstrip()
+            if data_bytes == b"[DONE]":
+                return
+            if not data_bytes:
+                continue
+            if (
+                required_marker is not None
+                and required_marker not in data_bytes
+                and b'"error"' not in data_bytes
+            ):
+                continue
+            yield data_bytes
+
+    @staticmethod
+    def _parse_sse_frame(data_bytes: bytes, provider_name: str) -> dict | None:
+        """Разбирает JSON-кадр SSE.
+
+        Кадры с ошибкой и нераспознанные строки с текстом rate limit / auth
+        превращаются в исключения так же, как ответы с кодом ошибки.
+        """
+        try:
+            data = orjson.loads(data_bytes)
+        except orjson.JSONDecodeError:
+            # Распознаём ошибку только в кадрах, которые не разобрались как JSON
+            _classify_error(data_bytes.decode("utf-8", errors="ignore"))
+            return None
+
+        if not isinstance(data, dict):
+            return None
+
+        if "error" in data:
+            error_obj = data["error"]
+            logger.warning("%s stream error: %s", provider_name, error_obj)
+            _classify_error(error_obj)
+            error_msg = error_obj.get("message", str(error_obj)) if isinstance(error_obj, dict) else str(error_obj)
+            raise AiError(f"{provider_name} stream error: {error_msg[:200]}")
+
+        return data
+
+    @classmethod
+    async def _sse_events(
+        cls,
+        resp: aiohttp.ClientResponse,
+        provider_name: str,
+        required_marker: bytes | None = None,
+        stall_timeout: float | None = None,
+    ) -> AsyncGenerator[dict, None]:
+        """Общий SSE-парсер: отдаёт JSON-кадры из строк `data:` до `[DONE]`."""
+        async for data_bytes in cls._sse_data(resp, required_marker, stall_timeout):
+            data = cls._parse_sse_frame(data_bytes, provider_name)
+            if data is not None:
+                yield data
+
     @staticmethod
     def _convert_messages_to_gemini(
         messages: list[dict[str, str]],
     ) -> list[dict]:
-        contents = []
+        # Один проход: подряд идущие сообщения одной роли склеиваем через join.
+        # Gemini требует, чтобы диалог начинался с user, — приветствие кладём сразу,
+        # а не вставляем в начало готового списка
+        merged: list[dict] = []
+        if messages and messages[0]["role"] == "assistant":
+            merged.append({"role": "user", "parts": [{"text": "Hello"}]})
+        current_role: str | None = None
+        current_texts: list[str] = []
         for msg in messages:
             role = msg["role"]
             if role == "assistant":
                 role = "model"
             elif role == "system":
                 role = "user"
-            contents.append({
-                "role": role,
-                "parts": [{"text": msg["content"]}],
-            })
-
-        if not contents:
-            return contents
 
-        merged: list[dict] = [contents[0]]
-        for c in contents[1:]:
-            if c["role"] == merged[-1]["role"]:
-                merged[-1]["parts"][0]["text"] += "\n" + c["parts"][0]["text"]
-            else:
-                merged.append(c)
-
-        if merged and merged[0]["role"] == "model":
-            merged.insert(0, {"role": "user", "parts": [{"text": "Hello"}]})
+            if role != current_role:
+                if current_texts:
+                    merged.append({
+                        "role": current_role,
+                        "parts": [{"text": "\n".join(current_texts)}],
+                    })
+                current_role = role
+                current_texts = []
+            current_texts.append(msg["content"])
+
+        if current_texts:
+            merged.append({
+                "role": current_role,
+                "parts": [{"text": "\n".join(current_texts)}],
+            })
 
         return merged
\ No newline at end of file
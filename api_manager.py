@@ -2,13 +2,19 @@ import asyncio
 import hashlib
 import logging
 import time
+from collections import defaultdict
 from dataclasses import dataclass, field
+from functools import cached_property
+
+from multidict import CIMultiDict, CIMultiDictProxy
 
 from config import Config
 from database import Database
 
 logger = logging.getLogger(__name__)
 
+OPENROUTER_REFERER = "https://github.com/ai-telegram-bot"
+
 
 @dataclass
 class KeyState:
@@ -18,64 +24,133 @@ class KeyState:
     status: str = "active"
     last_exhausted: float = 0.0
 
+    @cached_property
+    def openrouter_headers(self) -> CIMultiDictProxy[str]:
+        # Собираем один раз на ключ, а не на каждый запрос; aiohttp не пересобирает
+        # CIMultiDict, если ему передать уже готовый
+        return CIMultiDictProxy(CIMultiDict({
+            "Authorization": f"Bearer {self.raw_key}",
+            "HTTP-Referer": OPENROUTER_REFERER,
+            "Content-Type": "application/json",
+        }))
+
+    @cached_property
+    def gemini_params(self) -> dict[str, str]:
+        return {"key": self.raw_key, "alt": "sse"}
+
 
 class ApiKeyManager:
     def __init__(self, config: Config, database: Database) -> None:
         self._config = config
         self._db = database
         self._keys: dict[str, list[KeyState]] = {"openrouter": [], "gemini": []}
+        self._by_hash: dict[str, KeyState] = {}
+        # Активные ключи поддерживаем при смене статуса, а не пересчитываем в get_key
+        self._active: dict[str, list[KeyState]] = {"openrouter": [], "gemini": []}
         self._current_index: dict[str, int] = {"openrouter": 0, "gemini": 0}
         self._locks: dict[str, asyncio.Lock] = {
             "openrouter": asyncio.Lock(),
             "gemini": asyncio.Lock(),
         }
         self._recovery_task: asyncio.Task | None = None
+        # Счётчики использования копим в памяти и сбрасываем в БД пачкой
+        self._pending_usage: defaultdict[str, int] = defaultdict(int)
+        self._usage_task: asyncio.Task | None = None
 
     @staticmethod
     def _hash_key(key: str) -> str:
+        return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+    @staticmethod
+    def _legacy_hash_key(key: str) -> str:
+        # Прежний формат key_hash — нужен только для переноса старых строк api_keys
         return hashlib.sha256(key.encode()).hexdigest()[:16]
 
     async def initialize(self) -> None:
-        for raw_key in self._config.api.openrouter_keys:
-            ks = KeyState(
-                raw_key=raw_key,
-                key_hash=self._hash_key(raw_key),
-                provider="openrouter",
-            )
-            self._keys["openrouter"].append(ks)
-            await self._db.upsert_api_key("openrouter", ks.key_hash)
-
-        for raw_key in self._config.api.gemini_keys:
-            ks = KeyState(
-                raw_key=raw_key,
-                key_hash=self._hash_key(raw_key),
-                provider="gemini",
-            )
-            self._keys["gemini"].append(ks)
-            await self._db.upsert_api_key("gemini", ks.key_hash)
-
-        # Синхронизируем статусы из БД
+        await self._db.rename_api_key_hashes([
+            (self._legacy_hash_key(k), self._hash_key(k))
+            for k in (*self._config.api.openrouter_keys, *self._config.api.gemini_keys)
+        ])
+
+        for provider, raw_keys in (
+            ("openrouter", self._config.api.openrouter_keys),
+            ("gemini", self._config.api.gemini_keys),
+        ):
+            for raw_key in raw_keys:
+                ks = KeyState(
+                    raw_key=raw_key,
+                    key_hash=self._hash_key(raw_key),
+                    provider=provider,
+                )
+                self._keys[provider].append(ks)
+                self._by_hash[ks.key_hash] = ks
+
+        await self._db.upsert_api_keys([
+            (ks.provider, ks.key_hash) for keys in self._keys.values() for ks in keys
+        ])
+
+        # Синхронизируем статусы из БД одним запросом на все провайдеры
+        db_map = {k["key_hash"]: k["status"] for k in await self._db.get_api_keys()}
         for provider in ("openrouter", "gemini"):
-            db_keys = await self._db.get_api_keys(provider)
-            db_map = {k["key_hash"]: k["status"] for k in db_keys}
             for ks in self._keys[provider]:
                 if ks.key_hash in db_map:
                     ks.status = db_map[ks.key_hash]
+            self._refresh_active(provider)
 
         total = sum(len(v) for v in self._keys.values())
         active = sum(1 for keys in self._keys.values() for k in keys if k.status == "active")
         logger.info("API keys loaded: %d total, %d active", total, active)
 
+    def _refresh_active(self, provider: str) -> None:
+        """Пересобирает список активных ключей провайдера. Вызывать под локом провайдера.
+
+        Список всегда заменяется новым объектом, чтобы get_key мог читать его без лока.
+        """
+        self._active[provider] = [k for k in self._keys[provider] if k.status == "active"]
+
+    def _find_key(self, key_hash: str, provider: str) -> KeyState | None:
+        ks = self._by_hash.get(key_hash)
+        if ks is None or ks.provider != provider:
+            return None
+        return ks
+
     def start_recovery_loop(self) -> None:
         self._recovery_task = asyncio.create_task(self._recovery_loop())
+        self._usage_task = asyncio.create_task(self._usage_flush_loop())
 
     async def stop_recovery_loop(self) -> None:
-        if self._recovery_task:
-            self._recovery_task.cancel()
+        for task in (self._recovery_task, self._usage_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        # Досбрасываем то, что накопилось с последнего тика
+        await self._flush_usage()
+
+    async def _usage_flush_loop(self) -> None:
+        while True:
             try:
-                await self._recovery_task
+                await asyncio.sleep(5)
+                await self._flush_usage()
             except asyncio.CancelledError:
-                pass
+                break
+            except Exception as e:
+                logger.error("Usage flush error: %s", e)
+
+    async def _flush_usage(self) -> None:
+        if not self._pending_usage:
+            return
+        # Подменяем словарь до await, чтобы новые записи шли уже в свежий
+        pending, self._pending_usage = self._pending_usage, defaultdict(int)
+        try:
+            await self._db.increment_key_requests_batch(list(pending.items()))
+        except Exception:
+            # Не теряем счётчики: вернём их в буфер до следующей попытки
+            for key_hash, count in pending.items():
+                self._pending_usage[key_hash] += count
+            raise
 
     async def _recovery_loop(self) -> None:
         while True:
@@ -96,6 +171,7 @@ class ApiKeyManager:
                                         "Key %s (%s) recovered to active",
                                         ks.key_hash, provider,
                                     )
+                            self._refresh_active(provider)
             except asyncio.CancelledError:
                 break
             except Exception as e:
@@ -103,49 +179,56 @@ class ApiKeyManager:
                 await asyncio.sleep(60)
 
     async def get_key(self, provider: str) -> KeyState | None:
-        async with self._locks[provider]:
-            keys = self._keys.get(provider, [])
-            if not keys:
-                return None
+        # Без лока: внутри нет await, а список активных ключей не меняется на месте,
+        # а подменяется целиком в _refresh_active — читатель всегда видит целостный снимок
+        active_keys = self._active.get(provider)
+        if not active_keys:
+            return None
 
-            active_keys = [k for k in keys if k.status == "active"]
-            if not active_keys:
-                return None
+        idx = self._current_index[provider] % len(active_keys)
+        self._current_index[provider] = idx + 1
+        return active_keys[idx]
 
-            idx = self._current_index[provider] % len(active_keys)
-            self._current_index[provider] = idx + 1
-            return active_keys[idx]
-
-    async def mark_exhausted(self, key_hash: str, provider: str) -> None:
+    async def mark_exhausted(
+        self, key_hash: str, provider: str, retry_after: float | None = None
+    ) -> None:
+        # Если провайдер сообщил Retry-After, сдвигаем момент исчерпания так,
+        # чтобы ключ восстановился через retry_after, а не через полный cooldown
+        shift = 0.0
+        if retry_after is not None:
+            shift = retry_after - self._config.api.key_cooldown_minutes * 60
         async with self._locks[provider]:
-            for ks in self._keys[provider]:
-                if ks.key_hash == key_hash:
-                    ks.status = "exhausted"
-                    ks.last_exhausted = time.time()
-                    await self._db.update_key_status(key_hash, "exhausted")
-                    logger.warning("Key %s (%s) marked exhausted", key_hash, provider)
-                    break
+            ks = self._find_key(key_hash, provider)
+            if ks is None:
+                return
+            ks.status = "exhausted"
+            ks.last_exhausted = time.time() + shift
+            self._refresh_active(provider)
+            await self._db.update_key_status(key_hash, "exhausted", shift)
+            logger.warning("Key %s (%s) marked exhausted", key_hash, provider)
 
     async def mark_error(self, key_hash: str, provider: str) -> None:
         async with self._locks[provider]:
-            for ks in self._keys[provider]:
-                if ks.key_hash == key_hash:
-                    ks.status = "error"
-                    await self._db.update_key_status(key_hash, "error")
-                    logger.error("Key %s (%s) marked error (auth failure)", key_hash, provider)
-                    break
+            ks = self._find_key(key_hash, provider)
+            if ks is None:
+                return
+            ks.status = "error"
+            self._refresh_active(provider)
+            await self._db.update_key_status(key_hash, "error")
+            logger.error("Key %s (%s) marked error (auth failure)", key_hash, provider)
 
     async def mark_active(self, key_hash: str, provider: str) -> None:
         async with self._locks[provider]:
-            for ks in self._keys[provider]:
-                if ks.key_hash == key_hash:
-                    ks.status = "active"
-                    await self._db.update_key_status(key_hash, "active")
-                    logger.info("Key %s (%s) manually set to active", key_hash, provider)
-                    break
+            ks = self._find_key(key_hash, provider)
+            if ks is None:
+                return
+            ks.status = "active"
+            self._refresh_active(provider)
+            await self._db.update_key_status(key_hash, "active")
+            logger.info("Key %s (%s) manually set to active", key_hash, provider)
 
-    async def record_usage(self, key_hash: str) -> None:
-        await self._db.increment_key_requests(key_hash)
+    def record_usage(self, key_hash: str) -> None:
+        self._pending_usage[key_hash] += 1
 
     async def get_all_keys_status(self, provider: str | None = None) -> list[dict]:
         result = []
@@ -166,9 +249,12 @@ class ApiKeyManager:
                 })
         return result
 
+    def get_key_provider(self, key_hash: str) -> str | None:
+        ks = self._by_hash.get(key_hash)
+        return ks.provider if ks else None
+
     async def has_active_keys(self, provider: str) -> bool:
-        async with self._locks[provider]:
-            return any(k.status == "active" for k in self._keys.get(provider, []))
+        return bool(self._active.get(provider))
 
     async def get_recovery_time(self, provider: str) -> str | None:
         return await self._db.get_earliest_exhausted_recovery(
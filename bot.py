@@ -1,18 +1,22 @@
 import asyncio
+import atexit
 import logging
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 
 from config import load_config, Config
 from database import Database
 from api_manager import ApiKeyManager
 from ai_client import AiClient
 from context_manager import ContextManager
+from broadcast import fanout_send
 from middlewares import (
     UserRegistrationMiddleware,
     CallbackRegistrationMiddleware,
@@ -22,6 +26,41 @@ from middlewares import (
 from handlers import user, admin, callbacks
 
 
+class _KeepAliveSession(AiohttpSession):
+    """AiohttpSession с настраиваемым keep-alive пула соединений.
+
+    Публичного параметра для этого нет: опираемся на то, что в aiogram 3.15
+    (закреплён в requirements.txt) create_session строит TCPConnector из
+    _connector_init. При обновлении aiogram это место надо перепроверить.
+    """
+
+    def __init__(self, *, keepalive_timeout: float, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self._connector_init["keepalive_timeout"] = keepalive_timeout
+
+
+class _LogFileHandler(RotatingFileHandler):
+    """RotatingFileHandler без stat-вызовов на каждую запись.
+
+    Стандартный shouldRollover на каждый record проверяет os.path.exists/isfile
+    (защита от /dev/null и пайпов). Наш лог — всегда обычный файл, поэтому
+    проверяем это один раз при создании.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        path = Path(self.baseFilename)
+        self._rotatable = not path.exists() or path.is_file()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if not self._rotatable or self.maxBytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        msg = "%s\n" % self.format(record)
+        return self.stream.tell() + len(msg) >= self.maxBytes
+
+
 def setup_logging(config: Config) -> None:
     log_dir = Path(config.log.file).parent
     log_dir.mkdir(parents=True, exist_ok=True)
@@ -31,7 +70,7 @@ def setup_logging(config: Config) -> None:
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-    file_handler = RotatingFileHandler(
+    file_handler = _LogFileHandler(
         config.log.file,
         maxBytes=10 * 1024 * 1024,  # 10 MB
         backupCount=5,
@@ -42,10 +81,19 @@ def setup_logging(config: Config) -> None:
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
 
+    # Запись в файл и stdout уводим в отдельный поток: event loop только кладёт
+    # запись в очередь. Listener останавливаем при выходе из процесса, чтобы
+    # не потерять сообщения, залогированные уже после остановки бота
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+
     root_logger = logging.getLogger()
     root_logger.setLevel(config.log.level)
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    root_logger.addHandler(QueueHandler(log_queue))
 
     logging.getLogger("aiogram").setLevel(logging.WARNING)
     logging.getLogger("aiohttp").setLevel(logging.WARNING)
@@ -55,6 +103,11 @@ def setup_logging(config: Config) -> None:
 logger = logging.getLogger(__name__)
 
 
+async def _notify_admins(bot: Bot, config: Config, text: str) -> None:
+    # Параллельно: N админов — один сетевой round-trip, а не N подряд
+    await fanout_send(bot, config.admin_ids, text)
+
+
 async def on_startup(
     bot: Bot,
     config: Config,
@@ -70,11 +123,7 @@ async def on_startup(
     bot_info = await bot.get_me()
     logger.info("Bot started: @%s (ID: %d)", bot_info.username, bot_info.id)
 
-    for admin_id in config.admin_ids:
-        try:
-            await bot.send_message(admin_id, "✅ Бот запущен и готов к работе.")
-        except Exception:
-            pass
+    await _notify_admins(bot, config, "✅ Бот запущен и готов к работе.")
 
 
 async def on_shutdown(
@@ -86,11 +135,7 @@ async def on_shutdown(
 ) -> None:
     logger.info("Shutting down...")
 
-    for admin_id in config.admin_ids:
-        try:
-            await bot.send_message(admin_id, "⚠️ Бот останавливается...")
-        except Exception:
-            pass
+    await _notify_admins(bot, config, "⚠️ Бот останавливается...")
 
     await key_manager.stop_recovery_loop()
     await ai_client.close()
@@ -102,8 +147,14 @@ async def on_shutdown(
 async def stats_updater(database: Database) -> None:
     while True:
         try:
-            await asyncio.sleep(600)  # каждые 10 минут
-            await database.update_daily_stats()
+            # Пересчёт по накоплению новых сообщений, но не реже раза в 10 минут;
+            # если сообщений не было вовсе, пересчитывать нечего
+            try:
+                await asyncio.wait_for(database.wait_stats_dirty(), timeout=600)
+            except asyncio.TimeoutError:
+                pass
+            if database.has_stats_changes:
+                await database.update_daily_stats()
         except asyncio.CancelledError:
             break
         except Exception as e:
@@ -122,8 +173,13 @@ async def main() -> None:
     ai_client = AiClient(config, key_manager)
     context_manager = ContextManager(config, database)
 
+    # Держим соединения к Telegram API дольше дефолтных 15 с: между правками
+    # стримящегося ответа не платим за новый TLS handshake
+    session = _KeepAliveSession(limit=100, keepalive_timeout=75)
+
     bot = Bot(
         token=config.bot.token,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
 
@@ -140,8 +196,9 @@ async def main() -> None:
 
     # Middleware
     dp.message.middleware(LoggingMiddleware())
-    dp.message.middleware(UserRegistrationMiddleware(database))
+    # Throttle до регистрации: отброшенные сообщения не трогают БД и не идут в счётчик
     dp.message.middleware(ThrottleMiddleware(rate_limit=1.0))
+    dp.message.middleware(UserRegistrationMiddleware(database))
     dp.callback_query.middleware(CallbackRegistrationMiddleware(database))
 
     # Роутеры (порядок важен: admin перед user, чтобы /ban /unban /broadcast не попали в AI)
@@ -170,15 +227,31 @@ async def main() -> None:
 
     logger.info("Starting polling...")
     try:
+        # Накопившиеся за время простоя апдейты не разгребаем: ответы на них уже неактуальны
+        await bot.delete_webhook(drop_pending_updates=True)
         await dp.start_polling(
             bot,
-            allowed_updates=["message", "callback_query"],
+            allowed_updates=dp.resolve_used_update_types(),
+            polling_timeout=30,
+            handle_as_tasks=True,
         )
     finally:
         await bot.session.close()
 
 
+def _install_uvloop() -> None:
+    # uvloop ускоряет сокеты aiohttp и aiogram; на Windows его нет — остаёмся на стандартном цикле
+    if sys.platform == "win32":
+        return
+    try:
+        import uvloop
+    except ImportError:
+        return
+    uvloop.install()
+
+
 if __name__ == "__main__":
+    _install_uvloop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable, Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Одновременных send_message. Это лимит на запросы в полёте, а не на скорость:
+# сессия бота (bot.py) держит до 100 соединений, и рассылка оставляет в пуле
+# место правкам стримящихся ответов
+FANOUT_LIMIT = 25
+
+# Отправок в секунду: держимся под лимитом Telegram ~30 сообщений/с на бота
+FANOUT_RATE = 25.0
+
+# Сколько секунд с первой попытки получатель может ждать flood control
+RETRY_DEADLINE = 60.0
+
+
+class _RateLimiter:
+    """Раздаёт слоты отправки с шагом 1/rate секунд.
+
+    Flood control действует на бота целиком, поэтому pause() сдвигает слоты
+    всем отправкам, а не только той, что получила RetryAfter.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self._interval = 1.0 / rate
+        self._next = 0.0
+        self._paused_until = 0.0
+
+    async def wait(self) -> None:
+        while True:
+            now = time.monotonic()
+            slot = max(now, self._next, self._paused_until)
+            self._next = slot + self._interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # Пока ждали слот, кто-то получил RetryAfter — встаём в очередь после паузы
+            if self._paused_until <= slot:
+                return
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+async def fanout_send(
+    bot: Bot,
+    chat_ids: Iterable[int],
+    text: str,
+    limit: int = FANOUT_LIMIT,
+    rate: float = FANOUT_RATE,
+    on_progress: Callable[[int, int], Awaitable[None]] | None = None,
+) -> tuple[int, int]:
+    """Рассылает text по chat_ids: не больше limit запросов сразу и rate в секунду.
+
+    На RetryAfter получатель ждёт, сколько просит Telegram, пока укладывается
+    в RETRY_DEADLINE. Ошибки отдельных получателей не прерывают рассылку.
+    on_progress(sent, failed) вызывается после каждой доставки — сами отправки
+    в это время продолжаются. Возвращает (sent, failed).
+    """
+    sem = asyncio.Semaphore(limit)
+    limiter = _RateLimiter(rate)
+
+    async def send_one(chat_id: int) -> bool:
+        async with sem:
+            await limiter.wait()
+            deadline = time.monotonic() + RETRY_DEADLINE
+            while True:
+                try:
+                    await bot.send_message(chat_id, text)
+                    return True
+                except TelegramRetryAfter as e:
+                    # Паузу ставим и тогда, когда этот получатель сдаётся: иначе
+                    # остальные отправки продолжат биться в то же окно flood control
+                    limiter.pause(e.retry_after)
+                    if time.monotonic() + e.retry_after > deadline:
+                        logger.warning(
+                            "Send to %d dropped: flood control asks to wait %ds",
+                            chat_id, e.retry_after,
+                        )
+                        return False
+                except Exception as e:
+                    logger.debug("Send to %d failed: %s", chat_id, e)
+                    return False
+                await limiter.wait()
+
+    sent = failed = 0
+    for done in asyncio.as_completed([send_one(chat_id) for chat_id in chat_ids]):
+        if await done:
+            sent += 1
+        else:
+            failed += 1
+        if on_progress is not None:
+            await on_progress(sent, failed)
+    return sent, failed
@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+from functools import cached_property
 from pathlib import Path
 from dotenv import load_dotenv
 import os
@@ -19,6 +20,10 @@ def _parse_list(raw: str) -> list[str]:
     return [item.strip() for item in raw.split(",") if item.strip()]
 
 
+def _parse_bool(raw: str) -> bool:
+    return raw.strip().lower() in ("1", "true", "yes", "on")
+
+
 def _parse_int_list(raw: str) -> list[int]:
     result = []
     for item in raw.split(","):
@@ -41,6 +46,12 @@ class ApiConfig:
     default_model: str
     key_cooldown_minutes: int
     request_timeout: int
+    stream_stall_timeout: int
+    pool_limit: int
+    hedged_requests: bool
+    max_concurrent_streams: int
+    stream_coalesce_chars: int
+    stream_coalesce_ms: int
 
 
 @dataclass(frozen=True)
@@ -78,22 +89,33 @@ class Config:
     api: ApiConfig
     db: DatabaseConfig
     log: LogConfig
-    admin_ids: list[int]
+    # frozenset: проверка «это админ?» идёт на каждом админском колбэке
+    admin_ids: frozenset[int]
     max_context_messages: int
     models: list[ModelInfo] = field(default_factory=lambda: AVAILABLE_MODELS)
 
-    def get_model_info(self, model_id: str) -> ModelInfo | None:
+    # Индексы строятся один раз на экземпляр: cached_property пишет в __dict__
+    # в обход frozen-__setattr__
+    @cached_property
+    def _models_by_id(self) -> dict[str, ModelInfo]:
+        return {m.id: m for m in self.models}
+
+    @cached_property
+    def _models_by_provider(self) -> dict[str, tuple[ModelInfo, ...]]:
+        grouped: dict[str, list[ModelInfo]] = {}
         for m in self.models:
-            if m.id == model_id:
-                return m
-        return None
+            grouped.setdefault(m.provider, []).append(m)
+        return {p: tuple(ms) for p, ms in grouped.items()}
+
+    def get_model_info(self, model_id: str) -> ModelInfo | None:
+        return self._models_by_id.get(model_id)
 
     def get_provider_for_model(self, model_id: str) -> str | None:
         info = self.get_model_info(model_id)
         return info.provider if info else None
 
-    def get_models_by_provider(self, provider: str) -> list[ModelInfo]:
-        return [m for m in self.models if m.provider == provider]
+    def get_models_by_provider(self, provider: str) -> tuple[ModelInfo, ...]:
+        return self._models_by_provider.get(provider, ())
 
 
 def load_config() -> Config:
@@ -105,12 +127,18 @@ def load_config() -> Config:
         print("FATAL: At least one API key (OPENROUTER_KEYS or GEMINI_KEYS) must be provided.")
         sys.exit(1)
 
-    admin_ids = _parse_int_list(_get_env("ADMIN_IDS", ""))
+    admin_ids = frozenset(_parse_int_list(_get_env("ADMIN_IDS", "")))
     default_provider = _get_env("DEFAULT_PROVIDER", "openrouter")
     default_model = _get_env("DEFAULT_MODEL", "google/gemini-2.0-flash-exp:free")
     key_cooldown = int(_get_env("KEY_COOLDOWN_MINUTES", "60"))
     max_context = int(_get_env("MAX_CONTEXT_MESSAGES", "15"))
     request_timeout = int(_get_env("REQUEST_TIMEOUT", "120"))
+    stall_timeout = int(_get_env("STREAM_STALL_TIMEOUT", "30"))
+    pool_limit = int(_get_env("HTTP_POOL_LIMIT", "256"))
+    hedged_requests = _parse_bool(_get_env("HEDGED_REQUESTS", "false"))
+    max_streams = int(_get_env("MAX_CONCURRENT_STREAMS", "64"))
+    coalesce_chars = int(_get_env("STREAM_COALESCE_CHARS", "64"))
+    coalesce_ms = int(_get_env("STREAM_COALESCE_MS", "20"))
     db_path = _get_env("DATABASE_PATH", "data/bot.db")
     log_level = _get_env("LOG_LEVEL", "INFO")
     log_file = _get_env("LOG_FILE", "data/bot.log")
@@ -127,6 +155,12 @@ def load_config() -> Config:
             default_model=default_model,
             key_cooldown_minutes=key_cooldown,
             request_timeout=request_timeout,
+            stream_stall_timeout=stall_timeout,
+            pool_limit=pool_limit,
+            hedged_requests=hedged_requests,
+            max_concurrent_streams=max_streams,
+            stream_coalesce_chars=coalesce_chars,
+            stream_coalesce_ms=coalesce_ms,
         ),
         db=DatabaseConfig(path=db_path),
         log=LogConfig(level=log_level, file=log_file),
@@ -83,8 +83,8 @@ class ContextManager:
         return messages
 
     async def add_user_message(self, user_id: int, content: str) -> None:
+        # total_messages засчитывает UserRegistrationMiddleware вместе с регистрацией
         await self._db.save_message(user_id, "user", content)
-        await self._db.increment_user_messages(user_id)
 
     async def add_assistant_message(
         self,
@@ -105,7 +105,7 @@ class ContextManager:
     async def get_user_model(
         self, user_id: int
     ) -> tuple[str, str]:
-        provider, model = await self._db.get_user_model(user_id)
+        _, provider, model = await self._db.get_user_state(user_id)
         if not provider or not model:
             provider = self._config.api.default_provider
             model = self._config.api.default_model
@@ -1,27 +1,112 @@
 import aiosqlite
+import asyncio
 import logging
-from datetime import datetime, date
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import datetime, date, timedelta
 from pathlib import Path
+from typing import NamedTuple
 
 logger = logging.getLogger(__name__)
 
+# Как часто сбрасываем накопленные сообщения и счётчики в БД (секунды)
+FLUSH_INTERVAL = 0.1
+
+# Кэш is_banned: статус меняется только через /ban и /unban
+BAN_CACHE_TTL = 30.0
+BAN_CACHE_SIZE = 10_000
+
+# После стольких новых сообщений дневную статистику пересчитываем, не дожидаясь таймера
+STATS_DIRTY_THRESHOLD = 100
+
+_INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (user_id, role, content, model_used, response_time_ms, created_ts)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+class UserRow(NamedTuple):
+    user_id: int
+    is_banned: int
+    selected_provider: str | None
+    selected_model: str | None
+    total_messages: int
+
+
+class StatsSummary(NamedTuple):
+    total_users: int
+    total_messages: int
+    messages_today: int
+    avg_response_ms: float
+
+
+def _today_bounds() -> tuple[int, int]:
+    """Полуоткрытый интервал [сегодня, завтра) в unix-времени для сравнения с created_ts."""
+    start = datetime.combine(date.today(), datetime.min.time())
+    return int(start.timestamp()), int((start + timedelta(days=1)).timestamp())
+
 
 class Database:
     def __init__(self, db_path: str) -> None:
         self._path = db_path
         self._db: aiosqlite.Connection | None = None
+        # Отдельное read-only соединение: в WAL читатели не ждут писателя,
+        # а у aiosqlite у каждого соединения свой поток
+        self._db_ro: aiosqlite.Connection | None = None
+        # Записи сообщений копим и пишем одной транзакцией раз в FLUSH_INTERVAL
+        self._pending_messages: list[tuple] = []
+        # Соединение в autocommit. Одиночные записи коммитятся сами, пачки идут в явной
+        # транзакции (_transaction); лок не даёт одиночной записи попасть внутрь чужой пачки
+        self._tx_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        self._ban_cache: OrderedDict[int, tuple[bool, float]] = OrderedDict()
+        self._messages_since_stats = 0
+        self._stats_dirty = asyncio.Event()
 
     async def connect(self) -> None:
         Path(self._path).parent.mkdir(parents=True, exist_ok=True)
-        self._db = await aiosqlite.connect(self._path)
+        # sqlite3 кэширует подготовленные выражения по тексту SQL; все наши запросы —
+        # константные строки, так что с запасом по размеру кэша каждый парсится один раз
+        # isolation_level=None: драйвер не открывает транзакции сам, границы задаём
+        # явно в _transaction — пачка записей получает один BEGIN/COMMIT
+        self._db = await aiosqlite.connect(
+            self._path, cached_statements=256, isolation_level=None
+        )
         self._db.row_factory = aiosqlite.Row
         await self._db.execute("PRAGMA journal_mode=WAL")
+        # В WAL режим NORMAL не теряет целостность при сбое, но не делает fsync на каждый commit
+        await self._db.execute("PRAGMA synchronous=NORMAL")
+        await self._db.execute("PRAGMA temp_store=MEMORY")
+        await self._db.execute("PRAGMA cache_size=-20000")
+        await self._db.execute("PRAGMA mmap_size=268435456")
         await self._db.execute("PRAGMA foreign_keys=ON")
         await self._create_tables()
+
+        # Открываем после _create_tables: файл и схема к этому моменту уже есть
+        ro_uri = f"{Path(self._path).resolve().as_uri()}?mode=ro"
+        self._db_ro = await aiosqlite.connect(ro_uri, uri=True, cached_statements=256)
+        self._db_ro.row_factory = aiosqlite.Row
+        await self._db_ro.execute("PRAGMA cache_size=-20000")
+        await self._db_ro.execute("PRAGMA mmap_size=268435456")
+
+        self._flush_task = asyncio.create_task(self._flush_loop())
         logger.info("Database connected: %s", self._path)
 
     async def close(self) -> None:
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if self._db_ro:
+            await self._db_ro.close()
+            self._db_ro = None
         if self._db:
+            await self._flush_pending()
             await self._db.close()
             self._db = None
             logger.info("Database closed")
@@ -32,7 +117,19 @@ class Database:
             raise RuntimeError("Database not connected")
         return self._db
 
+    @property
+    def ro(self) -> aiosqlite.Connection:
+        """Соединение для чтений. Видит только закоммиченное — все записи коммитятся сразу."""
+        if self._db_ro is None:
+            raise RuntimeError("Database not connected")
+        return self._db_ro
+
     async def _create_tables(self) -> None:
+        cursor = await self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_active'"
+        )
+        has_daily_active = await cursor.fetchone() is not None
+
         await self.db.executescript("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -54,12 +151,12 @@ class Database:
                 model_used TEXT,
                 response_time_ms INTEGER,
                 created_at TEXT NOT NULL DEFAULT (datetime('now')),
+                -- Unix-время: целые сравнения и 8 байт вместо ISO-строки.
+                -- Заполняется кодом при вставке (см. save_message)
+                created_ts INTEGER,
                 FOREIGN KEY (user_id) REFERENCES users(user_id)
             );
 
-            CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id);
-            CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at);
-
             CREATE TABLE IF NOT EXISTS api_keys (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 provider TEXT NOT NULL,
@@ -78,93 +175,281 @@ class Database:
                 unique_users INTEGER NOT NULL DEFAULT 0,
                 avg_response_time REAL NOT NULL DEFAULT 0.0
             );
+
+            -- Кто писал в какой день: unique_users читается точечно, без COUNT(DISTINCT) по messages
+            CREATE TABLE IF NOT EXISTS daily_active (
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (day, user_id)
+            ) WITHOUT ROWID;
+        """)
+        await self._migrate_messages_ts()
+        if not has_daily_active:
+            # Таблица новая — один раз заполняем её по уже накопленной истории.
+            # День считаем по локальному времени, как и живые записи (date.today())
+            await self.db.execute(
+                "INSERT OR IGNORE INTO daily_active (day, user_id) "
+                "SELECT DISTINCT date(created_ts, 'unixepoch', 'localtime'), user_id FROM messages"
+            )
+
+    async def _migrate_messages_ts(self) -> None:
+        cursor = await self.db.execute("PRAGMA table_info(messages)")
+        columns = {row["name"] for row in await cursor.fetchall()}
+        if "created_ts" not in columns:
+            # ALTER TABLE не умеет неконстантный DEFAULT — переносим значения из created_at
+            async with self._transaction():
+                await self.db.execute("ALTER TABLE messages ADD COLUMN created_ts INTEGER")
+                await self.db.execute(
+                    "UPDATE messages SET created_ts = CAST(strftime('%s', created_at) AS INTEGER)"
+                )
+            logger.info("Migrated messages.created_at to integer created_ts")
+
+        await self.db.executescript("""
+            -- get_context: диапазон по user_id уже в порядке created_ts DESC, без сортировки.
+            -- id разводит сообщения одной секунды. Покрывает и поиск по одному user_id,
+            -- поэтому отдельный индекс не нужен
+            CREATE INDEX IF NOT EXISTS idx_messages_user_ts_id ON messages(user_id, created_ts DESC, id DESC);
+            DROP INDEX IF EXISTS idx_messages_user_ts;
+            CREATE INDEX IF NOT EXISTS idx_messages_created_ts ON messages(created_ts);
+            DROP INDEX IF EXISTS idx_messages_user_id;
+            DROP INDEX IF EXISTS idx_messages_user_recent;
+            DROP INDEX IF EXISTS idx_messages_created_at;
         """)
-        await self.db.commit()
+
+    @asynccontextmanager
+    async def _transaction(self) -> AsyncIterator[None]:
+        async with self._tx_lock:
+            async with self._atomic():
+                yield
+
+    @asynccontextmanager
+    async def _atomic(self) -> AsyncIterator[None]:
+        """BEGIN/COMMIT без захвата лока — для тех, кто уже держит _tx_lock."""
+        await self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            await self.db.execute("ROLLBACK")
+            raise
+        await self.db.execute("COMMIT")
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.sleep(FLUSH_INTERVAL)
+                await self._flush_pending()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error("Message flush error: %s", e)
+
+    async def _flush_pending(self) -> None:
+        """Пишет накопленные сообщения одной транзакцией.
+
+        Вызывается и перед чтениями messages, чтобы они видели только что сохранённое.
+        """
+        # Пустой буфер при свободном локе — писать нечего и чужой сброс не в полёте
+        if not self._pending_messages and not self._tx_lock.locked():
+            return
+        # Буфер забираем под локом: если другой сброс ещё пишет, дождёмся его коммита,
+        # иначе читатель после нас не увидел бы уже забранные из буфера строки
+        async with self._tx_lock:
+            if not self._pending_messages:
+                return
+            messages, self._pending_messages = self._pending_messages, []
+            try:
+                try:
+                    async with self._atomic():
+                        await self.db.executemany(_INSERT_MESSAGE_SQL, messages)
+                        await self._mark_daily_active(messages)
+                except aiosqlite.OperationalError:
+                    logger.warning("Flush of %d messages failed, requeued", len(messages))
+                    raise
+                except aiosqlite.Error as e:
+                    # Пачку сломала конкретная строка — пишем по одной, теряем только её
+                    logger.error("Batch flush failed (%s), retrying row by row", e)
+                    messages = await self._flush_rows(messages)
+            except BaseException:
+                # База занята, недоступна или сброс отменили (close() гасит _flush_loop) —
+                # транзакция откатилась, пачка цела: возвращаем её в начало очереди
+                self._pending_messages[:0] = messages
+                raise
+        self._messages_since_stats += len(messages)
+        if self._messages_since_stats >= STATS_DIRTY_THRESHOLD:
+            self._stats_dirty.set()
+
+    async def _flush_rows(self, messages: list[tuple]) -> list[tuple]:
+        """Пишет сообщения по одному и возвращает те, что удалось сохранить. Зовётся под _tx_lock."""
+        saved = []
+        async with self._atomic():
+            for row in messages:
+                try:
+                    await self.db.execute(_INSERT_MESSAGE_SQL, row)
+                except aiosqlite.Error as e:
+                    logger.error("Dropped message of user %s: %s", row[0], e)
+                    continue
+                saved.append(row)
+            await self._mark_daily_active(saved)
+        return saved
+
+    async def _mark_daily_active(self, messages: list[tuple]) -> None:
+        today = date.today().isoformat()
+        await self.db.executemany(
+            "INSERT OR IGNORE INTO daily_active (day, user_id) VALUES (?, ?)",
+            [(today, user_id) for user_id in {m[0] for m in messages}],
+        )
+
+    @property
+    def has_stats_changes(self) -> bool:
+        return self._messages_since_stats > 0 or bool(self._pending_messages)
+
+    async def wait_stats_dirty(self) -> None:
+        """Ждёт, пока с последнего пересчёта статистики не наберётся STATS_DIRTY_THRESHOLD сообщений."""
+        await self._stats_dirty.wait()
 
     # ---- Users ----
 
     async def upsert_user(
         self, user_id: int, username: str | None, first_name: str | None
-    ) -> None:
-        await self.db.execute(
-            """
-            INSERT INTO users (user_id, username, first_name)
-            VALUES (?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username = excluded.username,
-                first_name = excluded.first_name,
-                last_active = datetime('now')
-            """,
-            (user_id, username, first_name),
-        )
-        await self.db.commit()
+    ) -> bool:
+        """Регистрирует пользователя и заодно возвращает is_banned — без второго запроса."""
+        async with self._tx_lock:
+            rows = await self.db.execute_fetchall(
+                """
+                INSERT INTO users (user_id, username, first_name)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_active = datetime('now')
+                RETURNING is_banned
+                """,
+                (user_id, username, first_name),
+            )
+        banned = bool(rows[0]["is_banned"])
+        self._cache_ban(user_id, banned)
+        return banned
 
-    async def get_user(self, user_id: int) -> dict | None:
-        cursor = await self.db.execute(
-            "SELECT * FROM users WHERE user_id = ?", (user_id,)
+    async def touch_user(
+        self,
+        user_id: int,
+        username: str | None,
+        first_name: str | None,
+        inc_messages: bool = False,
+    ) -> bool:
+        """Регистрирует пользователя и, если нужно, засчитывает сообщение — одним UPSERT.
+
+        Возвращает is_banned; сообщения забаненных не засчитываются.
+        """
+        inc = int(inc_messages)
+        # execute_fetchall дочитывает RETURNING до конца: незакрытый оператор
+        # держал бы autocommit-транзакцию открытой
+        async with self._tx_lock:
+            rows = await self.db.execute_fetchall(
+                """
+                INSERT INTO users (user_id, username, first_name, total_messages)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    total_messages = total_messages + CASE WHEN is_banned THEN 0 ELSE ? END,
+                    last_active = datetime('now')
+                RETURNING is_banned
+                """,
+                (user_id, username, first_name, inc, inc),
+            )
+        banned = bool(rows[0]["is_banned"])
+        self._cache_ban(user_id, banned)
+        return banned
+
+    async def get_user(self, user_id: int) -> UserRow | None:
+        cursor = await self.ro.execute(
+            "SELECT user_id, is_banned, selected_provider, selected_model, total_messages "
+            "FROM users WHERE user_id = ?",
+            (user_id,),
         )
         row = await cursor.fetchone()
-        return dict(row) if row else None
+        return UserRow._make(row) if row else None
+
+    def peek_ban(self, user_id: int) -> bool | None:
+        """Статус бана из кэша без обращения к БД; None — в кэше нет или запись устарела."""
+        cached = self._ban_cache.get(user_id)
+        if cached is not None and time.monotonic() - cached[1] < BAN_CACHE_TTL:
+            self._ban_cache.move_to_end(user_id)
+            return cached[0]
+        return None
 
     async def is_banned(self, user_id: int) -> bool:
-        cursor = await self.db.execute(
+        cached = self.peek_ban(user_id)
+        if cached is not None:
+            return cached
+
+        cursor = await self.ro.execute(
             "SELECT is_banned FROM users WHERE user_id = ?", (user_id,)
         )
         row = await cursor.fetchone()
-        return bool(row["is_banned"]) if row else False
+        banned = bool(row["is_banned"]) if row else False
+        self._cache_ban(user_id, banned)
+        return banned
 
     async def set_ban(self, user_id: int, banned: bool) -> bool:
-        cursor = await self.db.execute(
-            "UPDATE users SET is_banned = ? WHERE user_id = ?",
-            (int(banned), user_id),
-        )
-        await self.db.commit()
+        async with self._tx_lock:
+            cursor = await self.db.execute(
+                "UPDATE users SET is_banned = ? WHERE user_id = ?",
+                (int(banned), user_id),
+            )
+        if cursor.rowcount > 0:
+            self._cache_ban(user_id, banned)
         return cursor.rowcount > 0
 
-    async def increment_user_messages(self, user_id: int) -> None:
-        await self.db.execute(
-            """
-            UPDATE users SET total_messages = total_messages + 1,
-                             last_active = datetime('now')
-            WHERE user_id = ?
-            """,
-            (user_id,),
-        )
-        await self.db.commit()
+    def _cache_ban(self, user_id: int, banned: bool) -> None:
+        self._ban_cache[user_id] = (banned, time.monotonic())
+        self._ban_cache.move_to_end(user_id)
+        if len(self._ban_cache) > BAN_CACHE_SIZE:
+            self._ban_cache.popitem(last=False)
 
     async def set_user_model(
         self, user_id: int, provider: str, model: str
     ) -> None:
-        await self.db.execute(
-            "UPDATE users SET selected_provider = ?, selected_model = ? WHERE user_id = ?",
-            (provider, model, user_id),
-        )
-        await self.db.commit()
+        async with self._tx_lock:
+            await self.db.execute(
+                "UPDATE users SET selected_provider = ?, selected_model = ? WHERE user_id = ?",
+                (provider, model, user_id),
+            )
 
-    async def get_user_model(self, user_id: int) -> tuple[str | None, str | None]:
-        cursor = await self.db.execute(
-            "SELECT selected_provider, selected_model FROM users WHERE user_id = ?",
+    async def get_user_state(
+        self, user_id: int
+    ) -> tuple[bool, str | None, str | None]:
+        """Бан и выбранная модель одним запросом: (is_banned, provider, model).
+
+        Заодно освежает кэш is_banned, так что следующая проверка бана
+        в middleware обходится без SELECT.
+        """
+        cursor = await self.ro.execute(
+            "SELECT is_banned, selected_provider, selected_model FROM users WHERE user_id = ?",
             (user_id,),
         )
         row = await cursor.fetchone()
-        if row:
-            return row["selected_provider"], row["selected_model"]
-        return None, None
+        if not row:
+            return False, None, None
+        banned = bool(row["is_banned"])
+        self._cache_ban(user_id, banned)
+        return banned, row["selected_provider"], row["selected_model"]
 
     async def get_all_user_ids(self) -> list[int]:
-        cursor = await self.db.execute(
+        cursor = await self.ro.execute(
             "SELECT user_id FROM users WHERE is_banned = 0"
         )
         rows = await cursor.fetchall()
         return [row["user_id"] for row in rows]
 
     async def get_total_users(self) -> int:
-        cursor = await self.db.execute("SELECT COUNT(*) as cnt FROM users")
+        cursor = await self.ro.execute("SELECT COUNT(*) as cnt FROM users")
         row = await cursor.fetchone()
         return row["cnt"]
 
     async def get_top_users(self, limit: int = 10) -> list[dict]:
-        cursor = await self.db.execute(
+        cursor = await self.ro.execute(
             "SELECT user_id, username, first_name, total_messages, last_active "
             "FROM users ORDER BY total_messages DESC LIMIT ?",
             (limit,),
@@ -182,124 +467,162 @@ class Database:
         model_used: str | None = None,
         response_time_ms: int | None = None,
     ) -> None:
-        await self.db.execute(
-            """
-            INSERT INTO messages (user_id, role, content, model_used, response_time_ms)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (user_id, role, content, model_used, response_time_ms),
+        # Время фиксируем в момент сохранения, а не при сбросе буфера
+        self._pending_messages.append(
+            (user_id, role, content, model_used, response_time_ms, int(time.time()))
         )
-        await self.db.commit()
 
     async def get_context(
         self, user_id: int, limit: int = 15
     ) -> list[dict[str, str]]:
-        cursor = await self.db.execute(
+        await self._flush_pending()
+        # Последние N берём прямо по индексу (user_id, created_ts DESC, id DESC), а в хронологический
+        # порядок разворачиваем в Python — без внешней пересортировки во временном B-tree
+        cursor = await self.ro.execute(
             """
-            SELECT role, content FROM (
-                SELECT role, content, created_at FROM messages
-                WHERE user_id = ? AND role IN ('user', 'assistant')
-                ORDER BY created_at DESC LIMIT ?
-            ) sub ORDER BY created_at ASC
+            SELECT role, content FROM messages
+            WHERE user_id = ? AND role IN ('user', 'assistant')
+            ORDER BY created_ts DESC, id DESC LIMIT ?
             """,
             (user_id, limit),
         )
         rows = await cursor.fetchall()
-        return [{"role": row["role"], "content": row["content"]} for row in rows]
+        return [{"role": row["role"], "content": row["content"]} for row in reversed(rows)]
 
     async def clear_context(self, user_id: int) -> int:
-        cursor = await self.db.execute(
-            "DELETE FROM messages WHERE user_id = ?", (user_id,)
-        )
-        await self.db.commit()
+        # Иначе сообщения из буфера доедут в БД уже после очистки
+        await self._flush_pending()
+        async with self._tx_lock:
+            cursor = await self.db.execute(
+                "DELETE FROM messages WHERE user_id = ?", (user_id,)
+            )
         return cursor.rowcount
 
     async def get_messages_today(self) -> int:
-        today = date.today().isoformat()
-        cursor = await self.db.execute(
-            "SELECT COUNT(*) as cnt FROM messages WHERE date(created_at) = ?",
-            (today,),
+        await self._flush_pending()
+        cursor = await self.ro.execute(
+            "SELECT COUNT(*) as cnt FROM messages WHERE created_ts >= ? AND created_ts < ?",
+            _today_bounds(),
         )
         row = await cursor.fetchone()
         return row["cnt"]
 
     async def get_total_messages(self) -> int:
-        cursor = await self.db.execute("SELECT COUNT(*) as cnt FROM messages")
+        await self._flush_pending()
+        cursor = await self.ro.execute("SELECT COUNT(*) as cnt FROM messages")
         row = await cursor.fetchone()
         return row["cnt"]
 
     async def get_avg_response_time(self) -> float:
-        cursor = await self.db.execute(
+        await self._flush_pending()
+        cursor = await self.ro.execute(
             """
             SELECT AVG(response_time_ms) as avg_ms FROM messages
-            WHERE response_time_ms IS NOT NULL AND date(created_at) = date('now')
-            """
+            WHERE response_time_ms IS NOT NULL AND created_ts >= ? AND created_ts < ?
+            """,
+            _today_bounds(),
         )
         row = await cursor.fetchone()
         return round(row["avg_ms"] or 0.0, 1)
 
-    # ---- API Keys ----
-
-    async def upsert_api_key(self, provider: str, key_hash: str) -> None:
-        await self.db.execute(
+    async def get_stats_summary(self) -> StatsSummary:
+        """Сводка для админ-панели одним запросом вместо четырёх."""
+        await self._flush_pending()
+        # AVG сам пропускает NULL, поэтому отдельный фильтр по response_time_ms не нужен
+        cursor = await self.ro.execute(
             """
-            INSERT INTO api_keys (provider, key_hash)
-            VALUES (?, ?)
-            ON CONFLICT(key_hash) DO NOTHING
+            SELECT
+                (SELECT COUNT(*) FROM users) AS total_users,
+                (SELECT COUNT(*) FROM messages) AS total_messages,
+                COUNT(*) AS messages_today,
+                AVG(response_time_ms) AS avg_ms
+            FROM messages
+            WHERE created_ts >= ? AND created_ts < ?
             """,
-            (provider, key_hash),
+            _today_bounds(),
         )
-        await self.db.commit()
+        row = await cursor.fetchone()
+        return StatsSummary(
+            row["total_users"],
+            row["total_messages"],
+            row["messages_today"],
+            round(row["avg_ms"] or 0.0, 1),
+        )
+
+    # ---- API Keys ----
+
+    async def upsert_api_keys(self, rows: list[tuple[str, str]]) -> None:
+        async with self._transaction():
+            await self.db.executemany(
+                """
+                INSERT INTO api_keys (provider, key_hash)
+                VALUES (?, ?)
+                ON CONFLICT(key_hash) DO NOTHING
+                """,
+                rows,
+            )
+
+    async def rename_api_key_hashes(self, pairs: list[tuple[str, str]]) -> None:
+        # OR IGNORE: если строка с новым хешем уже есть, старую не трогаем
+        async with self._transaction():
+            await self.db.executemany(
+                "UPDATE OR IGNORE api_keys SET key_hash = ? WHERE key_hash = ?",
+                [(new, old) for old, new in pairs],
+            )
 
     async def get_api_keys(self, provider: str | None = None) -> list[dict]:
         if provider:
-            cursor = await self.db.execute(
+            cursor = await self.ro.execute(
                 "SELECT * FROM api_keys WHERE provider = ? ORDER BY id",
                 (provider,),
             )
         else:
-            cursor = await self.db.execute(
+            cursor = await self.ro.execute(
                 "SELECT * FROM api_keys ORDER BY provider, id"
             )
         rows = await cursor.fetchall()
         return [dict(r) for r in rows]
 
-    async def update_key_status(self, key_hash: str, status: str) -> None:
+    async def update_key_status(
+        self, key_hash: str, status: str, exhausted_shift_seconds: float = 0.0
+    ) -> None:
         extra = ""
+        params: tuple = (status, key_hash)
         if status == "exhausted":
-            extra = ", last_exhausted = datetime('now'), exhausted_count = exhausted_count + 1"
-        await self.db.execute(
-            f"UPDATE api_keys SET status = ?{extra} WHERE key_hash = ?",
-            (status, key_hash),
-        )
-        await self.db.commit()
+            extra = ", last_exhausted = datetime('now', ?), exhausted_count = exhausted_count + 1"
+            params = (status, f"{exhausted_shift_seconds:+.0f} seconds", key_hash)
+        async with self._tx_lock:
+            await self.db.execute(
+                f"UPDATE api_keys SET status = ?{extra} WHERE key_hash = ?",
+                params,
+            )
 
-    async def increment_key_requests(self, key_hash: str) -> None:
-        await self.db.execute(
-            """
-            UPDATE api_keys SET total_requests = total_requests + 1,
-                                last_used = datetime('now')
-            WHERE key_hash = ?
-            """,
-            (key_hash,),
-        )
-        await self.db.commit()
+    async def increment_key_requests_batch(self, items: list[tuple[str, int]]) -> None:
+        async with self._transaction():
+            await self.db.executemany(
+                """
+                UPDATE api_keys SET total_requests = total_requests + ?,
+                                    last_used = datetime('now')
+                WHERE key_hash = ?
+                """,
+                [(count, key_hash) for key_hash, count in items],
+            )
 
     async def reset_exhausted_keys(self, provider: str, cooldown_minutes: int) -> int:
-        cursor = await self.db.execute(
-            """
-            UPDATE api_keys SET status = 'active'
-            WHERE provider = ? AND status = 'exhausted'
-            AND last_exhausted IS NOT NULL
-            AND (julianday('now') - julianday(last_exhausted)) * 1440 >= ?
-            """,
-            (provider, cooldown_minutes),
-        )
-        await self.db.commit()
+        async with self._tx_lock:
+            cursor = await self.db.execute(
+                """
+                UPDATE api_keys SET status = 'active'
+                WHERE provider = ? AND status = 'exhausted'
+                AND last_exhausted IS NOT NULL
+                AND (julianday('now') - julianday(last_exhausted)) * 1440 >= ?
+                """,
+                (provider, cooldown_minutes),
+            )
         return cursor.rowcount
 
     async def get_active_key_count(self, provider: str) -> int:
-        cursor = await self.db.execute(
+        cursor = await self.ro.execute(
             "SELECT COUNT(*) as cnt FROM api_keys WHERE provider = ? AND status = 'active'",
             (provider,),
         )
@@ -307,7 +630,7 @@ class Database:
         return row["cnt"]
 
     async def get_earliest_exhausted_recovery(self, provider: str, cooldown_minutes: int) -> str | None:
-        cursor = await self.db.execute(
+        cursor = await self.ro.execute(
             """
             SELECT MIN(datetime(last_exhausted, '+' || ? || ' minutes')) as recovery
             FROM api_keys
@@ -323,23 +646,26 @@ class Database:
     async def update_daily_stats(self) -> None:
         today = date.today().isoformat()
         messages_today = await self.get_messages_today()
-        cursor = await self.db.execute(
-            "SELECT COUNT(DISTINCT user_id) as cnt FROM messages WHERE date(created_at) = ?",
+        # get_messages_today уже сбросил буфер — всё, что было до этого, попадёт в пересчёт
+        self._messages_since_stats = 0
+        self._stats_dirty.clear()
+        cursor = await self.ro.execute(
+            "SELECT COUNT(*) as cnt FROM daily_active WHERE day = ?",
             (today,),
         )
         row = await cursor.fetchone()
         unique_today = row["cnt"]
         avg_time = await self.get_avg_response_time()
 
-        await self.db.execute(
-            """
-            INSERT INTO bot_stats (date, total_requests, unique_users, avg_response_time)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(date) DO UPDATE SET
-                total_requests = excluded.total_requests,
-                unique_users = excluded.unique_users,
-                avg_response_time = excluded.avg_response_time
-            """,
-            (today, messages_today, unique_today, avg_time),
-        )
-        await self.db.commit()
\ No newline at end of file
+        async with self._tx_lock:
+            await self.db.execute(
+                """
+                INSERT INTO bot_stats (date, total_requests, unique_users, avg_response_time)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(date) DO UPDATE SET
+                    total_requests = excluded.total_requests,
+                    unique_users = excluded.unique_users,
+                    avg_response_time = excluded.avg_response_time
+                """,
+                (today, messages_today, unique_today, avg_time),
+            )
\ No newline at end of file
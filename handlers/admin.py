@@ -1,8 +1,11 @@
+import asyncio
 import logging
 import os
 import platform
 import time
+from collections.abc import Awaitable, Callable
 from datetime import datetime
+from typing import Any
 
 import psutil
 from aiogram import Router, F
@@ -13,31 +16,110 @@ from aiogram.enums import ParseMode
 from config import Config
 from database import Database
 from api_manager import ApiKeyManager
+from broadcast import fanout_send
 
 logger = logging.getLogger(__name__)
 router = Router(name="admin")
 
 BOT_START_TIME = time.monotonic()
 
+# Процесс и платформа не меняются за время жизни бота
+_PROC = psutil.Process(os.getpid())
+# Первый вызов без интервала только запоминает точку отсчёта и возвращает 0.0
+_PROC.cpu_percent(interval=None)
+_PYTHON_VERSION = platform.python_version()
+_OS_NAME = f"{platform.system()} {platform.release()}"
+
+# Память меняется медленно: замер (RSS бота в MB, % RAM системы) живёт MEM_SAMPLE_TTL секунд
+MEM_SAMPLE_TTL = 2.0
+_mem_sample: tuple[float, float, float] | None = None
+
+# Панели, которые перерисовываются кнопкой «Обновить»: повторные клики в пределах TTL
+# отдаём из памяти, не трогая БД. Изменения через админку сбрасывают запись сразу
+PANEL_CACHE_TTL = 3.0
+_panel_cache: dict[str, tuple[float, Any]] = {}
+
+# Рассылка идёт на фоне обычной работы бота: берём меньше общего лимита Telegram
+# (~30 msg/s), оставляя запас под ответы пользователям и правки статуса рассылки
+BROADCAST_RATE = 20.0
+BROADCAST_PROGRESS_INTERVAL = 2.0
+
+_KEY_EXHAUST_PREFIX = "adm:key_exhaust:"
+_KEY_ACTIVATE_PREFIX = "adm:key_activate:"
+
+_STATUS_EMOJI = {"active": "🟢", "exhausted": "🟡", "error": "🔴"}
+
 
 def _is_admin(user_id: int, config: Config) -> bool:
     return user_id in config.admin_ids
 
 
-def _admin_main_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="📊 Статистика", callback_data="adm:stats"),
-            InlineKeyboardButton(text="🔑 API-ключи", callback_data="adm:keys"),
-        ],
-        [
-            InlineKeyboardButton(text="👥 Пользователи", callback_data="adm:users"),
-            InlineKeyboardButton(text="⚙️ Система", callback_data="adm:system"),
-        ],
-        [
-            InlineKeyboardButton(text="📨 Рассылка", callback_data="adm:broadcast"),
-        ],
-    ])
+async def _cached_panel(name: str, build: Callable[[], Awaitable[Any]]) -> Any:
+    now = time.monotonic()
+    hit = _panel_cache.get(name)
+    if hit is not None and now - hit[0] < PANEL_CACHE_TTL:
+        return hit[1]
+    value = await build()
+    _panel_cache[name] = (now, value)
+    return value
+
+
+def _invalidate_panel(name: str) -> None:
+    _panel_cache.pop(name, None)
+
+
+async def _show(callback: CallbackQuery, text: str, keyboard: InlineKeyboardMarkup) -> None:
+    """Перерисовывает сообщение панели и закрывает «часики» на кнопке одновременно."""
+    results = await asyncio.gather(
+        callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN),
+        callback.answer(),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Admin panel update failed: %s", result)
+
+
+# Статичные клавиатуры собираем один раз при импорте, а не на каждый клик
+_ADMIN_MAIN_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="📊 Статистика", callback_data="adm:stats"),
+        InlineKeyboardButton(text="🔑 API-ключи", callback_data="adm:keys"),
+    ],
+    [
+        InlineKeyboardButton(text="👥 Пользователи", callback_data="adm:users"),
+        InlineKeyboardButton(text="⚙️ Система", callback_data="adm:system"),
+    ],
+    [
+        InlineKeyboardButton(text="📨 Рассылка", callback_data="adm:broadcast"),
+    ],
+])
+
+_BACK_BUTTON = InlineKeyboardButton(text="◀️ Назад", callback_data="adm:main")
+
+_STATS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔄 Обновить", callback_data="adm:stats")],
+    [_BACK_BUTTON],
+])
+
+_USERS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="🚫 Забанить", callback_data="adm:ban_prompt"),
+        InlineKeyboardButton(text="✅ Разбанить", callback_data="adm:unban_prompt"),
+    ],
+    [InlineKeyboardButton(text="🔄 Обновить", callback_data="adm:users")],
+    [_BACK_BUTTON],
+])
+
+_SYSTEM_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔄 Обновить", callback_data="adm:system")],
+    [_BACK_BUTTON],
+])
+
+_KEYS_TAIL_ROWS = (
+    [InlineKeyboardButton(text="🔄 Обновить", callback_data="adm:keys")],
+    [_BACK_BUTTON],
+)
 
 
 @router.message(Command("admin"))
@@ -48,7 +130,7 @@ async def cmd_admin(message: Message, config: Config) -> None:
 
     await message.answer(
         "🛠 **Админ-панель**\nВыберите раздел:",
-        reply_markup=_admin_main_keyboard(),
+        reply_markup=_ADMIN_MAIN_KB,
         parse_mode=ParseMode.MARKDOWN,
     )
 
@@ -56,10 +138,7 @@ async def cmd_admin(message: Message, config: Config) -> None:
 # ──────────── Stats ────────────
 
 async def _build_stats_text(db: Database) -> str:
-    total_users = await db.get_total_users()
-    total_messages = await db.get_total_messages()
-    today_messages = await db.get_messages_today()
-    avg_response = await db.get_avg_response_time()
+    total_users, total_messages, today_messages, avg_response = await db.get_stats_summary()
 
     return (
         "📊 **Статистика бота**\n\n"
@@ -76,19 +155,13 @@ async def cb_stats(callback: CallbackQuery, config: Config, database: Database)
         await callback.answer("⛔ Нет доступа.", show_alert=True)
         return
 
-    text = await _build_stats_text(database)
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="adm:stats")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="adm:main")],
-    ])
-    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
-    await callback.answer()
+    text = await _cached_panel("stats", lambda: _build_stats_text(database))
+    await _show(callback, text, _STATS_KB)
 
 
 # ──────────── API Keys ────────────
 
-async def _build_keys_text(key_manager: ApiKeyManager) -> str:
-    all_keys = await key_manager.get_all_keys_status()
+def _build_keys_text(all_keys: list[dict]) -> str:
     if not all_keys:
         return "🔑 **API-ключи**\n\nКлючи не найдены."
 
@@ -100,11 +173,8 @@ async def _build_keys_text(key_manager: ApiKeyManager) -> str:
             current_provider = k["provider"]
             lines.append(f"\n**{current_provider.upper()}:**")
 
-        status_emoji = {"active": "🟢", "exhausted": "🟡", "error": "🔴"}.get(
-            k["status"], "⚪"
-        )
         lines.append(
-            f"{status_emoji} `{k['key_hash']}` — "
+            f"{_STATUS_EMOJI.get(k['status'], '⚪')} `{k['key_hash']}` — "
             f"{k['status']} | "
             f"Запросов: {k['total_requests']} | "
             f"Исчерпан: {k['exhausted_count']}x"
@@ -123,16 +193,15 @@ def _build_keys_keyboard(all_keys: list[dict]) -> InlineKeyboardMarkup:
         if k["status"] == "active":
             buttons.append([InlineKeyboardButton(
                 text=f"⏸ Исчерпать {short}",
-                callback_data=f"adm:key_exhaust:{key_hash}",
+                callback_data=f"{_KEY_EXHAUST_PREFIX}{key_hash}",
             )])
         elif k["status"] in ("exhausted", "error"):
             buttons.append([InlineKeyboardButton(
                 text=f"▶️ Активировать {short}",
-                callback_data=f"adm:key_activate:{key_hash}",
+                callback_data=f"{_KEY_ACTIVATE_PREFIX}{key_hash}",
             )])
 
-    buttons.append([InlineKeyboardButton(text="🔄 Обновить", callback_data="adm:keys")])
-    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="adm:main")])
+    buttons.extend(_KEYS_TAIL_ROWS)
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
@@ -144,14 +213,11 @@ async def cb_keys(
         await callback.answer("⛔ Нет доступа.", show_alert=True)
         return
 
-    text = await _build_keys_text(key_manager)
-    all_keys = await key_manager.get_all_keys_status()
-    keyboard = _build_keys_keyboard(all_keys)
-    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
-    await callback.answer()
+    all_keys = await _cached_panel("keys", key_manager.get_all_keys_status)
+    await _show(callback, _build_keys_text(all_keys), _build_keys_keyboard(all_keys))
 
 
-@router.callback_query(F.data.startswith("adm:key_exhaust:"))
+@router.callback_query(F.data.startswith(_KEY_EXHAUST_PREFIX))
 async def cb_key_exhaust(
     callback: CallbackQuery, config: Config, key_manager: ApiKeyManager
 ) -> None:
@@ -159,23 +225,27 @@ async def cb_key_exhaust(
         await callback.answer("⛔ Нет доступа.", show_alert=True)
         return
 
-    key_hash = callback.data.split(":", 2)[2]
-    all_keys = await key_manager.get_all_keys_status()
-    target = next((k for k in all_keys if k["key_hash"] == key_hash), None)
-    if target:
-        await key_manager.mark_exhausted(key_hash, target["provider"])
-        await callback.answer(f"Ключ {key_hash[:8]} помечен как exhausted", show_alert=True)
-    else:
+    key_hash = callback.data[len(_KEY_EXHAUST_PREFIX):]
+    provider = key_manager.get_key_provider(key_hash)
+    if provider is None:
+        # Чужой или подделанный callback_data — отвечаем без обращения к БД и перерисовки
         await callback.answer("Ключ не найден", show_alert=True)
+        return
 
-    # Обновляем список
-    text = await _build_keys_text(key_manager)
-    all_keys = await key_manager.get_all_keys_status()
-    keyboard = _build_keys_keyboard(all_keys)
-    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    await key_manager.mark_exhausted(key_hash, provider)
+    _invalidate_panel("keys")
+    await callback.answer(f"Ключ {key_hash[:8]} помечен как exhausted", show_alert=True)
+
+    # Обновляем список: статус после изменения запрашиваем один раз на текст и клавиатуру
+    all_keys = await _cached_panel("keys", key_manager.get_all_keys_status)
+    await callback.message.edit_text(
+        _build_keys_text(all_keys),
+        reply_markup=_build_keys_keyboard(all_keys),
+        parse_mode=ParseMode.MARKDOWN,
+    )
 
 
-@router.callback_query(F.data.startswith("adm:key_activate:"))
+@router.callback_query(F.data.startswith(_KEY_ACTIVATE_PREFIX))
 async def cb_key_activate(
     callback: CallbackQuery, config: Config, key_manager: ApiKeyManager
 ) -> None:
@@ -183,19 +253,24 @@ async def cb_key_activate(
         await callback.answer("⛔ Нет доступа.", show_alert=True)
         return
 
-    key_hash = callback.data.split(":", 2)[2]
-    all_keys = await key_manager.get_all_keys_status()
-    target = next((k for k in all_keys if k["key_hash"] == key_hash), None)
-    if target:
-        await key_manager.mark_active(key_hash, target["provider"])
-        await callback.answer(f"Ключ {key_hash[:8]} активирован", show_alert=True)
-    else:
+    key_hash = callback.data[len(_KEY_ACTIVATE_PREFIX):]
+    provider = key_manager.get_key_provider(key_hash)
+    if provider is None:
+        # Чужой или подделанный callback_data — отвечаем без обращения к БД и перерисовки
         await callback.answer("Ключ не найден", show_alert=True)
+        return
 
-    text = await _build_keys_text(key_manager)
-    all_keys = await key_manager.get_all_keys_status()
-    keyboard = _build_keys_keyboard(all_keys)
-    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    await key_manager.mark_active(key_hash, provider)
+    _invalidate_panel("keys")
+    await callback.answer(f"Ключ {key_hash[:8]} активирован", show_alert=True)
+
+    # Обновляем список: статус после изменения запрашиваем один раз на текст и клавиатуру
+    all_keys = await _cached_panel("keys", key_manager.get_all_keys_status)
+    await callback.message.edit_text(
+        _build_keys_text(all_keys),
+        reply_markup=_build_keys_keyboard(all_keys),
+        parse_mode=ParseMode.MARKDOWN,
+    )
 
 
 # ──────────── Users ────────────
@@ -205,15 +280,13 @@ async def _build_users_text(db: Database) -> str:
     if not top:
         return "👥 **Пользователи**\n\nПока нет пользователей."
 
-    lines = ["👥 **Топ-10 активных пользователей:**\n"]
-    for i, u in enumerate(top, 1):
-        name = u["username"] or u["first_name"] or "Unknown"
-        lines.append(
-            f"{i}. **{name}** (ID: `{u['user_id']}`)\n"
-            f"   Сообщений: {u['total_messages']} | "
-            f"Последняя активность: {u['last_active'] or 'н/д'}"
-        )
-    return "\n".join(lines)
+    body = "\n".join(
+        f"{i}. **{u['username'] or u['first_name'] or 'Unknown'}** (ID: `{u['user_id']}`)\n"
+        f"   Сообщений: {u['total_messages']} | "
+        f"Последняя активность: {u['last_active'] or 'н/д'}"
+        for i, u in enumerate(top, 1)
+    )
+    return f"👥 **Топ-10 активных пользователей:**\n\n{body}"
 
 
 @router.callback_query(F.data == "adm:users")
@@ -222,17 +295,8 @@ async def cb_users(callback: CallbackQuery, config: Config, database: Database)
         await callback.answer("⛔ Нет доступа.", show_alert=True)
         return
 
-    text = await _build_users_text(database)
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="🚫 Забанить", callback_data="adm:ban_prompt"),
-            InlineKeyboardButton(text="✅ Разбанить", callback_data="adm:unban_prompt"),
-        ],
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="adm:users")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="adm:main")],
-    ])
-    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
-    await callback.answer()
+    text = await _cached_panel("users", lambda: _build_users_text(database))
+    await _show(callback, text, _USERS_KB)
 
 
 @router.callback_query(F.data == "adm:ban_prompt")
@@ -275,6 +339,7 @@ async def cmd_ban(message: Message, config: Config, database: Database) -> None:
         return
 
     success = await database.set_ban(target_id, True)
+    _invalidate_panel("users")
     if success:
         await message.answer(f"🚫 Пользователь `{target_id}` забанен.", parse_mode=ParseMode.MARKDOWN)
     else:
@@ -293,6 +358,7 @@ async def cmd_unban(message: Message, config: Config, database: Database) -> Non
 
     target_id = int(parts[1])
     success = await database.set_ban(target_id, False)
+    _invalidate_panel("users")
     if success:
         await message.answer(f"✅ Пользователь `{target_id}` разбанен.", parse_mode=ParseMode.MARKDOWN)
     else:
@@ -301,27 +367,35 @@ async def cmd_unban(message: Message, config: Config, database: Database) -> Non
 
 # ──────────── System ────────────
 
+def _memory_sample() -> tuple[float, float]:
+    global _mem_sample
+    now = time.monotonic()
+    if _mem_sample is None or now - _mem_sample[0] >= MEM_SAMPLE_TTL:
+        _mem_sample = (
+            now,
+            _PROC.memory_info().rss / 1024 / 1024,
+            psutil.virtual_memory().percent,
+        )
+    return _mem_sample[1], _mem_sample[2]
+
+
 def _build_system_text() -> str:
     uptime_seconds = time.monotonic() - BOT_START_TIME
     hours, remainder = divmod(int(uptime_seconds), 3600)
     minutes, seconds = divmod(remainder, 60)
-    uptime_str = f"{hours}ч {minutes}м {seconds}с"
-
-    process = psutil.Process(os.getpid())
-    mem_mb = process.memory_info().rss / 1024 / 1024
-    cpu_percent = process.cpu_percent(interval=0.1)
 
-    total_mem = psutil.virtual_memory()
-    sys_mem_used = total_mem.percent
+    mem_mb, sys_mem_used = _memory_sample()
+    # Без interval не блокируем event loop: загрузка считается с предыдущего вызова
+    cpu_percent = _PROC.cpu_percent(interval=None)
 
     return (
         "⚙️ **Информация о системе**\n\n"
-        f"⏱ Аптайм: **{uptime_str}**\n"
+        f"⏱ Аптайм: **{hours}ч {minutes}м {seconds}с**\n"
         f"🧠 RAM бота: **{mem_mb:.1f} MB**\n"
         f"💻 CPU бота: **{cpu_percent:.1f}%**\n"
         f"📦 RAM системы: **{sys_mem_used:.1f}%**\n"
-        f"🐍 Python: **{platform.python_version()}**\n"
-        f"💿 ОС: **{platform.system()} {platform.release()}**"
+        f"🐍 Python: **{_PYTHON_VERSION}**\n"
+        f"💿 ОС: **{_OS_NAME}**"
     )
 
 
@@ -332,12 +406,7 @@ async def cb_system(callback: CallbackQuery, config: Config) -> None:
         return
 
     text = _build_system_text()
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="adm:system")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="adm:main")],
-    ])
-    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
-    await callback.answer()
+    await _show(callback, text, _SYSTEM_KB)
 
 
 # ──────────── Broadcast ────────────
@@ -375,24 +444,24 @@ async def cmd_broadcast(message: Message, config: Config, database: Database) ->
 
     status_msg = await message.answer(f"📨 Рассылка {len(user_ids)} пользователям...")
 
-    sent = 0
-    failed = 0
-    for uid in user_ids:
+    # Прогресс обновляем не чаще раза в BROADCAST_PROGRESS_INTERVAL: правка статуса — тоже запрос к Telegram
+    last_update = time.monotonic()
+
+    async def report(sent: int, failed: int) -> None:
+        nonlocal last_update
+        done = sent + failed
+        now = time.monotonic()
+        if now - last_update < BROADCAST_PROGRESS_INTERVAL:
+            return
+        last_update = now
         try:
-            await message.bot.send_message(uid, text)
-            sent += 1
+            await status_msg.edit_text(f"📨 Рассылка... {done}/{len(user_ids)}")
         except Exception:
-            failed += 1
-
-        if (sent + failed) % 25 == 0:
-            try:
-                await status_msg.edit_text(
-                    f"📨 Рассылка... {sent + failed}/{len(user_ids)}"
-                )
-            except Exception:
-                pass
-            # Telegram rate limit: ~30 msg/sec
-            await asyncio.sleep(1)
+            pass
+
+    sent, failed = await fanout_send(
+        message.bot, user_ids, text, rate=BROADCAST_RATE, on_progress=report
+    )
 
     await status_msg.edit_text(
         f"✅ Рассылка завершена.\n"
@@ -409,9 +478,4 @@ async def cb_main(callback: CallbackQuery, config: Config) -> None:
         await callback.answer("⛔ Нет доступа.", show_alert=True)
         return
 
-    await callback.message.edit_text(
-        "🛠 **Админ-панель**\nВыберите раздел:",
-        reply_markup=_admin_main_keyboard(),
-        parse_mode=ParseMode.MARKDOWN,
-    )
-    await callback.answer()
\ No newline at end of file
+    await _show(callback, "🛠 **Админ-панель**\nВыберите раздел:", _ADMIN_MAIN_KB)
\ No newline at end of file
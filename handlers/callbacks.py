@@ -7,41 +7,20 @@ from aiogram.enums import ParseMode
 from config import Config
 from context_manager import ContextManager
 from api_manager import ApiKeyManager
+from handlers.user import MODEL_MAP, MODEL_NAMES, SET_MODEL_PREFIX
 
 logger = logging.getLogger(__name__)
 router = Router(name="callbacks")
 
 
-# Тот же маппинг что и в user.py
-MODEL_MAP = {
-    "or1": ("openrouter", "google/gemini-2.0-flash-exp:free"),
-    "or2": ("openrouter", "meta-llama/llama-3.3-70b-instruct:free"),
-    "or3": ("openrouter", "mistralai/mistral-small-24b-instruct-2501:free"),
-    "or4": ("openrouter", "qwen/qwen2.5-vl-72b-instruct:free"),
-    "gm1": ("gemini", "gemini-2.0-flash"),
-    "gm2": ("gemini", "gemini-1.5-flash"),
-    "gm3": ("gemini", "gemini-1.5-pro"),
-}
-
-MODEL_NAMES = {
-    "or1": "Gemini 2.0 Flash (free)",
-    "or2": "Llama 3.3 70B (free)",
-    "or3": "Mistral Small 24B (free)",
-    "or4": "Qwen 2.5 VL 72B (free)",
-    "gm1": "Gemini 2.0 Flash",
-    "gm2": "Gemini 1.5 Flash",
-    "gm3": "Gemini 1.5 Pro",
-}
-
-
-@router.callback_query(F.data.startswith("sm:"))
+@router.callback_query(F.data.startswith(SET_MODEL_PREFIX))
 async def cb_set_model(
     callback: CallbackQuery,
     config: Config,
     context_manager: ContextManager,
     key_manager: ApiKeyManager,
 ) -> None:
-    short_id = callback.data.split(":", 1)[1]
+    short_id = callback.data[len(SET_MODEL_PREFIX):]
 
     if short_id not in MODEL_MAP:
         await callback.answer("❌ Модель не найдена.", show_alert=True)
@@ -1,11 +1,15 @@
 import asyncio
 import logging
 import time
+from collections import OrderedDict
+from functools import lru_cache
+from weakref import WeakValueDictionary
 
-from aiogram import Router, F
+from aiogram import Router
 from aiogram.filters import Command, CommandStart
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 from config import Config
 from ai_client import AiClient, AiError, AllKeysExhaustedError
@@ -14,9 +18,10 @@ from context_manager import ContextManager
 logger = logging.getLogger(__name__)
 router = Router(name="user")
 
-WELCOME_TEXT = """👋 **Привет, {name}!**
+PARSE_MD = ParseMode.MARKDOWN
 
-Я — AI-ассистент. Просто напиши мне сообщение, и я отвечу.
+# Приветствие с именем собирается f-строкой в cmd_start, здесь — неизменная часть
+WELCOME_TEXT = """Я — AI-ассистент. Просто напиши мне сообщение, и я отвечу.
 
 🔹 /models — выбрать модель AI
 🔹 /clear — очистить историю диалога
@@ -34,7 +39,10 @@ HELP_TEXT = """📖 **Список команд:**
 Просто отправь текстовое сообщение — я отвечу с помощью AI.
 Бот помнит последние 15 сообщений диалога."""
 
-# Короткие ID для callback_data (лимит Telegram — 64 байта)
+# Короткие ID для callback_data (лимит Telegram — 64 байта).
+# Единственный источник: callbacks.py разбирает нажатия по этим же словарям
+SET_MODEL_PREFIX = "sm:"
+
 MODEL_MAP = {
     "or1": ("openrouter", "google/gemini-2.0-flash-exp:free"),
     "or2": ("openrouter", "meta-llama/llama-3.3-70b-instruct:free"),
@@ -56,19 +64,216 @@ MODEL_NAMES = {
     "gm3": "Gemini 1.5 Pro",
 }
 
+_OPENROUTER_SHORT_IDS = tuple(k for k in MODEL_MAP if k.startswith("or"))
+_GEMINI_SHORT_IDS = tuple(k for k in MODEL_MAP if k.startswith("gm"))
+
+# Строки клавиатуры /models по провайдерам: заголовок секции и кнопки моделей
+_OPENROUTER_ROWS = (
+    [InlineKeyboardButton(text="── OpenRouter ──", callback_data="noop")],
+    *(
+        [InlineKeyboardButton(
+            text=f"🟢 {MODEL_NAMES[key]}", callback_data=f"{SET_MODEL_PREFIX}{key}"
+        )]
+        for key in _OPENROUTER_SHORT_IDS
+    ),
+)
+_GEMINI_ROWS = (
+    [InlineKeyboardButton(text="── Google Gemini ──", callback_data="noop")],
+    *(
+        [InlineKeyboardButton(
+            text=f"🔵 {MODEL_NAMES[key]}", callback_data=f"{SET_MODEL_PREFIX}{key}"
+        )]
+        for key in _GEMINI_SHORT_IDS
+    ),
+)
+
+# Промежуточные правки при стриминге: пока ответ короткий, обновляем чаще и мельче,
+# к лимиту сообщения — реже. Строки: (длина ответа до, интервал в секундах, мин. прирост)
+EDIT_CADENCE = (
+    (500, 1.0, 24),
+    (2000, 1.2, 100),
+)
+EDIT_INTERVAL = 1.5
+EDIT_MIN_CHARS = 200
+
+
+def _edit_cadence(length: int) -> tuple[float, int]:
+    for max_len, interval, min_chars in EDIT_CADENCE:
+        if length < max_len:
+            return interval, min_chars
+    return EDIT_INTERVAL, EDIT_MIN_CHARS
+
+
+# В одном чате (группе) могут одновременно стримиться ответы разным пользователям, а лимит
+# Telegram на правки — общий на чат. Промежуточные правки разводим по слотам не чаще
+# CHAT_EDIT_INTERVAL; chat_id -> момент следующего свободного слота, старые в начале
+CHAT_EDIT_INTERVAL = 1.0
+_chat_next_edit: OrderedDict[int, float] = OrderedDict()
+
+
+def _reserve_chat_slot(chat_id: int) -> float:
+    """Занимает ближайший слот правки в чате и возвращает, сколько до него ждать."""
+    now = time.monotonic()
+    slot = max(now, _chat_next_edit.get(chat_id, 0.0))
+    _chat_next_edit[chat_id] = slot + CHAT_EDIT_INTERVAL
+    _chat_next_edit.move_to_end(chat_id)
+    while True:
+        _, free_at = next(iter(_chat_next_edit.items()))
+        if free_at >= now:
+            break
+        _chat_next_edit.popitem(last=False)
+    return slot - now
+
+
+class _StreamPreview:
+    """Показывает стримящийся ответ правками сообщения из фоновой задачи.
+
+    Чтение стрима не ждёт сетевых правок: add() только копит куски и будит публикатор,
+    а тот раз в интервал отправляет последний снимок текста.
+    """
+
+    def __init__(self, message: Message) -> None:
+        self._message = message
+        # Куски склеиваем только в момент правки: += по растущей строке
+        # копировал бы весь накопленный ответ на каждом куске
+        self._parts: list[str] = []
+        self._len = 0
+        self.has_content = False
+        self._pending = asyncio.Event()
+        self._task = asyncio.create_task(self._publish_loop())
+
+    def add(self, chunk: str) -> None:
+        self._parts.append(chunk)
+        self._len += len(chunk)
+        # Проверяем на пустоту только приходящие куски, пока не встретим непробельный
+        if not self.has_content:
+            if not chunk.strip():
+                return
+            self.has_content = True
+        self._pending.set()
+
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    async def close(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _publish_loop(self) -> None:
+        last_edit_time = 0.0
+        # До этого момента правки не шлём: Telegram ответил flood control
+        suppress_until = 0.0
+        edited_len = 0
+        while True:
+            await self._pending.wait()
+            interval, min_chars = _edit_cadence(self._len)
+            # Первую правку делаем при любом приросте, чтобы заменить «Думаю...» поскорее
+            if not edited_len:
+                min_chars = 1
+            delay = max(last_edit_time + interval, suppress_until) - time.monotonic()
+            if delay > 0:
+                # Пока ждём, куски продолжают копиться — отправим уже свежий снимок
+                await asyncio.sleep(delay)
+            self._pending.clear()
+            if self._len - edited_len < min_chars:
+                continue
+            wait = _reserve_chat_slot(self._message.chat.id)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            edited_len = self._len
+            truncated = edited_len > 4000
+            if truncated:
+                display = f"{self.text()[:4000]}… ▌"
+            else:
+                display = f"{self.text()} ▌"
+            try:
+                await self._message.edit_text(display, parse_mode=None)
+                last_edit_time = time.monotonic()
+                # Дальше видимая часть не меняется — до финальной правки превью больше не трогаем
+                if truncated:
+                    return
+            except TelegramRetryAfter as e:
+                suppress_until = time.monotonic() + e.retry_after
+            except Exception:
+                pass
+
+
+def _markdown_balanced(text: str) -> bool:
+    """Грубая проверка, что Telegram примет текст в legacy Markdown.
+
+    Повторяет его правила: сущности не вкладываются, `код` и ```блоки``` закрываются,
+    *жирный* и _курсив_ парные, [ открывает ссылку [текст](url), \\ экранирует
+    следующий символ.
+    """
+    open_mark = None
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == "\\":
+            i += 2
+            continue
+        if open_mark is None and c == "`":
+            fence = "```" if text.startswith("```", i) else "`"
+            end = text.find(fence, i + len(fence))
+            if end < 0:
+                return False
+            i = end + len(fence)
+            continue
+        if open_mark is None and c == "[":
+            label_end = text.find("](", i + 1)
+            url_end = text.find(")", label_end + 2) if label_end >= 0 else -1
+            if url_end < 0:
+                return False
+            i = url_end + 1
+            continue
+        if c == "*" or c == "_":
+            if open_mark is None:
+                open_mark = c
+            elif open_mark == c:
+                open_mark = None
+        i += 1
+    return open_mark is None
+
+
+async def _edit_final(message: Message, text: str) -> None:
+    """Финальная правка ответа: Markdown, если Telegram его примет, иначе простой текст.
+
+    Заведомо битую разметку не отправляем — это лишний запрос с ошибкой 400.
+    """
+    if _markdown_balanced(text):
+        try:
+            await message.edit_text(text, parse_mode=PARSE_MD)
+            return
+        except TelegramBadRequest:
+            # Разметка, которую не распознала проверка, — покажем ответ без неё
+            pass
+        except Exception as e:
+            logger.warning("Final edit failed: %s", e)
+            return
+    try:
+        # parse_mode=None явно: по умолчанию у бота HTML, а ответ модели — не HTML
+        await message.edit_text(text, parse_mode=None)
+    except Exception as e:
+        logger.warning("Final edit failed: %s", e)
+
 
 @router.message(CommandStart())
 async def cmd_start(message: Message, config: Config) -> None:
     name = message.from_user.first_name or "друг"
     await message.answer(
-        WELCOME_TEXT.format(name=name),
-        parse_mode=ParseMode.MARKDOWN,
+        f"👋 **Привет, {name}!**\n\n{WELCOME_TEXT}",
+        parse_mode=PARSE_MD,
     )
 
 
 @router.message(Command("help"))
 async def cmd_help(message: Message) -> None:
-    await message.answer(HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
+    await message.answer(HELP_TEXT, parse_mode=PARSE_MD)
 
 
 @router.message(Command("clear"))
@@ -86,7 +291,7 @@ async def cmd_model(message: Message, context_manager: ContextManager, config: C
         f"🤖 **Текущая модель:**\n"
         f"Провайдер: `{provider}`\n"
         f"Модель: `{display_name}`",
-        parse_mode=ParseMode.MARKDOWN,
+        parse_mode=PARSE_MD,
     )
 
 
@@ -96,39 +301,46 @@ async def cmd_models(message: Message, config: Config) -> None:
     await message.answer(
         "🔧 **Выберите модель:**",
         reply_markup=keyboard,
-        parse_mode=ParseMode.MARKDOWN,
+        parse_mode=PARSE_MD,
     )
 
 
 def _build_models_keyboard(config: Config) -> InlineKeyboardMarkup:
-    buttons = []
+    return _models_keyboard(bool(config.api.openrouter_keys), bool(config.api.gemini_keys))
 
-    # OpenRouter
-    or_keys = [k for k in MODEL_MAP if k.startswith("or")]
-    if config.api.openrouter_keys:
-        buttons.append([InlineKeyboardButton(
-            text="── OpenRouter ──", callback_data="noop"
-        )])
-        for key in or_keys:
-            buttons.append([InlineKeyboardButton(
-                text=f"🟢 {MODEL_NAMES[key]}", callback_data=f"sm:{key}"
-            )])
-
-    # Gemini
-    gm_keys = [k for k in MODEL_MAP if k.startswith("gm")]
-    if config.api.gemini_keys:
-        buttons.append([InlineKeyboardButton(
-            text="── Google Gemini ──", callback_data="noop"
-        )])
-        for key in gm_keys:
-            buttons.append([InlineKeyboardButton(
-                text=f"🔵 {MODEL_NAMES[key]}", callback_data=f"sm:{key}"
-            )])
 
+# Клавиатура зависит только от того, какие провайдеры настроены, — собираем её один раз
+# на комбинацию и отдаём всем пользователям; состояния пользователя в ней нет
+@lru_cache(maxsize=4)
+def _models_keyboard(has_openrouter: bool, has_gemini: bool) -> InlineKeyboardMarkup:
+    buttons = []
+    if has_openrouter:
+        buttons.extend(_OPENROUTER_ROWS)
+    if has_gemini:
+        buttons.extend(_GEMINI_ROWS)
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-@router.message(F.text & ~F.text.startswith("/"))
+# Лок живёт, пока его держит или ждёт хотя бы один обработчик, — потом словарь его забывает
+_user_locks: WeakValueDictionary[int, asyncio.Lock] = WeakValueDictionary()
+
+
+def _user_lock(user_id: int) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[user_id] = lock
+    return lock
+
+
+def _is_user_text(message: Message) -> bool:
+    # Обычная функция вместо F.text & ~F.text.startswith("/"): фильтр проверяется на
+    # каждом текстовом апдейте, а MagicFilter каждый раз интерпретирует выражение
+    text = message.text
+    return bool(text) and not text.startswith("/")
+
+
+@router.message(_is_user_text)
 async def handle_message(
     message: Message,
     config: Config,
@@ -141,6 +353,20 @@ async def handle_message(
     if not user_text:
         return
 
+    # Сообщения одного пользователя обрабатываем по очереди: иначе два быстрых сообщения
+    # перемешают историю и запустят два запроса к AI с одним и тем же контекстом
+    async with _user_lock(user_id):
+        await _reply(message, config, user_id, user_text, ai_client, context_manager)
+
+
+async def _reply(
+    message: Message,
+    config: Config,
+    user_id: int,
+    user_text: str,
+    ai_client: AiClient,
+    context_manager: ContextManager,
+) -> None:
     provider, model = await context_manager.get_user_model(user_id)
 
     await context_manager.add_user_message(user_id, user_text)
@@ -150,37 +376,27 @@ async def handle_message(
     thinking_msg = await message.answer("💭 Думаю...")
 
     start_time = time.monotonic()
-    full_response = ""
-    last_edit_time = 0.0
+    preview = _StreamPreview(thinking_msg)
 
     try:
-        async for chunk in ai_client.stream_response(messages, model, provider):
-            full_response += chunk
-
-            now = time.monotonic()
-            if now - last_edit_time >= 1.5 and full_response.strip():
-                try:
-                    display = full_response
-                    if len(display) > 4000:
-                        display = display[:4000] + "…"
-                    await thinking_msg.edit_text(display + " ▌")
-                    last_edit_time = now
-                except Exception:
-                    pass
+        try:
+            # Общий срок на ответ: ретраи по ключам внутри stream_response могут вместе
+            # тянуться намного дольше одного запроса
+            async with asyncio.timeout(config.api.request_timeout):
+                async for chunk in ai_client.stream_response(messages, model, provider):
+                    preview.add(chunk)
+        finally:
+            # Останавливаем публикатор до финальной правки, чтобы он её не перезаписал
+            await preview.close()
 
         elapsed_ms = int((time.monotonic() - start_time) * 1000)
+        full_response = preview.text()
 
-        if full_response.strip():
+        if preview.has_content:
             display = full_response
             if len(display) > 4000:
                 display = display[:4000] + "…"
-            try:
-                await thinking_msg.edit_text(display, parse_mode=ParseMode.MARKDOWN)
-            except Exception:
-                try:
-                    await thinking_msg.edit_text(display)
-                except Exception:
-                    pass
+            await _edit_final(thinking_msg, display)
 
             await context_manager.add_assistant_message(
                 user_id, full_response, model, elapsed_ms
@@ -1,5 +1,7 @@
+import asyncio
 import logging
 import time
+from collections import OrderedDict
 from typing import Any, Awaitable, Callable
 
 from aiogram import BaseMiddleware
@@ -9,6 +11,21 @@ from database import Database
 
 logger = logging.getLogger(__name__)
 
+# Ссылки на фоновые записи, чтобы задачи не собрал GC до завершения
+_background: set[asyncio.Task] = set()
+
+
+def _run_in_background(coro: Awaitable[Any]) -> None:
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background_done)
+
+
+def _background_done(task: asyncio.Task) -> None:
+    _background.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background user update failed: %s", task.exception())
+
 
 class UserRegistrationMiddleware(BaseMiddleware):
     def __init__(self, database: Database) -> None:
@@ -22,20 +39,36 @@ class UserRegistrationMiddleware(BaseMiddleware):
     ) -> Any:
         user = event.from_user
         if user and not user.is_bot:
-            await self._db.upsert_user(
+            # Засчитываем те же сообщения, что уходят в AI (handle_message);
+            # бан touch_user возвращает тем же запросом и сам не даёт засчитать сообщение
+            text = event.text or ""
+            touch = self._db.touch_user(
                 user_id=user.id,
                 username=user.username,
                 first_name=user.first_name,
+                inc_messages=bool(text.strip()) and not text.startswith("/"),
             )
-            if await self._db.is_banned(user.id):
+            # Бан известен из кэша — запись не нужна обработчику, не ждём её
+            banned = self._db.peek_ban(user.id)
+            if banned is None:
+                banned = await touch
+            else:
+                _run_in_background(touch)
+            if banned:
                 await event.answer("⛔ Вы заблокированы.")
                 return None
         return await handler(event, data)
 
 
 class CallbackRegistrationMiddleware(BaseMiddleware):
+    # Нажатия кнопок идут очередями — профиль пользователя обновляем не чаще раза в
+    # UPSERT_INTERVAL секунд; бан проверяется каждый раз, но обычно из кэша Database
+    UPSERT_INTERVAL = 300.0
+
     def __init__(self, database: Database) -> None:
         self._db = database
+        # user_id -> время последнего upsert, старые записи в начале
+        self._upserted: OrderedDict[int, float] = OrderedDict()
 
     async def __call__(
         self,
@@ -45,12 +78,30 @@ class CallbackRegistrationMiddleware(BaseMiddleware):
     ) -> Any:
         user = event.from_user
         if user and not user.is_bot:
-            await self._db.upsert_user(
-                user_id=user.id,
-                username=user.username,
-                first_name=user.first_name,
-            )
-            if await self._db.is_banned(user.id):
+            now = time.monotonic()
+            last = self._upserted.get(user.id)
+            banned = self._db.peek_ban(user.id)
+            if last is None or now - last >= self.UPSERT_INTERVAL:
+                upsert = self._db.upsert_user(
+                    user_id=user.id,
+                    username=user.username,
+                    first_name=user.first_name,
+                )
+                if banned is None:
+                    banned = await upsert
+                else:
+                    _run_in_background(upsert)
+                self._upserted[user.id] = now
+                self._upserted.move_to_end(user.id)
+                cutoff = now - self.UPSERT_INTERVAL
+                while True:
+                    _, oldest = next(iter(self._upserted.items()))
+                    if oldest >= cutoff:
+                        break
+                    self._upserted.popitem(last=False)
+            elif banned is None:
+                banned = await self._db.is_banned(user.id)
+            if banned:
                 await event.answer("⛔ Вы заблокированы.", show_alert=True)
                 return None
         return await handler(event, data)
@@ -59,7 +110,9 @@ class CallbackRegistrationMiddleware(BaseMiddleware):
 class ThrottleMiddleware(BaseMiddleware):
     def __init__(self, rate_limit: float = 1.0) -> None:
         self._rate_limit = rate_limit
-        self._user_last: dict[int, float] = {}
+        # Порядок — по времени последнего пропущенного сообщения: старые записи в начале,
+        # и всё, что старше rate_limit, можно выбросить — на решение оно уже не влияет
+        self._user_last: OrderedDict[int, float] = OrderedDict()
 
     async def __call__(
         self,
@@ -72,12 +125,20 @@ class ThrottleMiddleware(BaseMiddleware):
             return await handler(event, data)
 
         now = time.monotonic()
-        last = self._user_last.get(user.id, 0.0)
+        last = self._user_last.get(user.id)
 
-        if now - last < self._rate_limit:
+        if last is not None and now - last < self._rate_limit:
             return None
 
         self._user_last[user.id] = now
+        self._user_last.move_to_end(user.id)
+        # Словарь держит только пользователей, писавших за последние rate_limit секунд
+        cutoff = now - self._rate_limit
+        while True:
+            _, oldest = next(iter(self._user_last.items()))
+            if oldest >= cutoff:
+                break
+            self._user_last.popitem(last=False)
         return await handler(event, data)
 
 
@@ -88,6 +149,14 @@ class LoggingMiddleware(BaseMiddleware):
         event: Update,
         data: dict[str, Any],
     ) -> Any:
+        # Без DEBUG трассировка и замер времени ушли бы в никуда — пишем только ошибки
+        if not logger.isEnabledFor(logging.DEBUG):
+            try:
+                return await handler(event, data)
+            except Exception as e:
+                logger.error("Handler error: %s: %s", type(e).__name__, e)
+                raise
+
         start = time.monotonic()
 
         if isinstance(event, Message) and event.from_user: